@@ -44,7 +44,9 @@ class ClassifierTarget(Base):
             clf_id=classifier.id, target_label_id=target_label.id)
         inst = cls.query.filter_by(**kwargs).first()
         if not inst:
+            from affine.model.reference_data import clear_reference_data
             inst = cls.create(**kwargs)
+            clear_reference_data()
         return inst
 
     @validates('page_qa_enabled')
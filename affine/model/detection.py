@@ -11,7 +11,7 @@ from vendor import langid
 from affine import config
 from affine.aws import sqs, s3client
 from affine.model.base import *
-from affine.model.detector_logging import detector_log
+from affine.model.detector_logging import detector_log, detector_log_many
 from affine.model._sqla_imports import *
 from affine.retries import retry_operation
 from affine import librato_tools
@@ -44,6 +44,20 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+# Rows per (page_id, clf_target_id) IN delete
+RESULT_DELETE_CHUNK_SIZE = 1000
+
+
+def _clf_target_ids_by_detector(detector_ids):
+    """Dict mapping each detector id to the ids of its clf targets"""
+    from affine.model.reference_data import reference_data
+    ref = reference_data()
+    if not all(detector_id in ref.classifiers for detector_id in detector_ids):
+        ref = reference_data(reload=True)
+    return {detector_id: {row.id for row in ref.clf_targets_of(detector_id)}
+            for detector_id in detector_ids}
+
+
 def time_process_video(func):
     """Decorator to time a process_video and submit duration to Librato.
 
@@ -196,6 +210,14 @@ class AbstractClassifier(ModelGrabberMixin, Base):
         return ClassifierTarget.query.filter_by(clf_id=self.id,
                                                 target_label_id=target_label_id).one()
 
+    def cached_clf_target(self, target_label_id=None):
+        """(id, clf_id, target_label_id) of the clf target that
+        get_clf_target (or clf_target if target_label_id is not given)
+        returns, from the reference data snapshot"""
+        from affine.model.reference_data import reference_lookup
+        return reference_lookup(
+            lambda ref: ref.clf_target(self.id, target_label_id))
+
 
 class AbstractTextDetector(AbstractClassifier):
 
@@ -225,23 +247,43 @@ class AbstractTextDetector(AbstractClassifier):
         num_pages = query.scalar()
         return num_pages / float(total_num_pages)
 
+    @classmethod
+    def get_all_coverage(cls):
+        """Returns a dict mapping the id of every enabled text detector to its
+        coverage, from counters that are kept up to date incrementally.
+        """
+        from affine.model.text_detection_coverage import text_detector_coverage
+        return text_detector_coverage().coverage()
+
     @classmethod
     def delete_detector_results(cls, page, detector_ids):
         """Delete tdrs for a given page for a given set of detectors"""
-        from affine.model.classifier_target_labels import ClassifierTarget
-        if detector_ids:
-            query = session.query(ClassifierTarget.id).filter(
-                ClassifierTarget.clf_id.in_(detector_ids))
-            clf_target_ids = {idx for (idx,) in query}
-            TextDetectorResult.query.filter_by(page=page).filter(
-                TextDetectorResult.clf_target_id.in_(clf_target_ids)).\
+        cls.delete_detector_results_for_pages({page.id: detector_ids})
+
+    @classmethod
+    def delete_detector_results_for_pages(cls, page_detector_ids):
+        """Delete tdrs for many pages at once.
+
+        page_detector_ids maps page_id to the ids of the detectors whose
+        results are deleted on that page.
+        """
+        detector_ids = set()
+        for ids in page_detector_ids.itervalues():
+            detector_ids.update(ids)
+        clf_target_ids = _clf_target_ids_by_detector(detector_ids)
+        rows = [(page_id, clf_target_id)
+                for page_id, ids in page_detector_ids.iteritems()
+                for detector_id in ids
+                for clf_target_id in clf_target_ids[detector_id]]
+        columns = tuple_(TextDetectorResult.page_id,
+                         TextDetectorResult.clf_target_id)
+        for i in xrange(0, len(rows), RESULT_DELETE_CHUNK_SIZE):
+            TextDetectorResult.query.filter(
+                columns.in_(rows[i:i + RESULT_DELETE_CHUNK_SIZE])).\
                 delete(synchronize_session=False)
 
     def save_result(self, page_id, target_label_id=None):
-        if not target_label_id:
-            clf_target = self.clf_target
-        else:
-            clf_target = self.get_clf_target(target_label_id)
+        clf_target = self.cached_clf_target(target_label_id or None)
         TextDetectorResult.log_result(page_id, clf_target.id)
 
 
@@ -362,6 +404,12 @@ class TextDetectorResult(Base):
     def log_result(cls, page_id, clf_target_id):
         detector_log("TDR", page_id, clf_target_id)
 
+    @classmethod
+    def log_results(cls, results):
+        """Logs many (page_id, clf_target_id) results in one write"""
+        detector_log_many([("TDR", page_id, clf_target_id)
+                           for page_id, clf_target_id in results])
+
     @classmethod
     def load_from_file(cls, tdr_file, on_duplicate='ignore'):
         cols = 'page_id, clf_target_id'
@@ -1,13 +1,16 @@
 import csv
 import logging
 import os
+import shutil
 import tempfile
 import uuid
 
 from affine import config
 from affine.log import set_handler
 
-__all__ = ['detector_log', 'flush_detector_log_to_db', 'reset_detector_log']
+__all__ = ['detector_log', 'detector_log_many', 'flush_detector_log_to_db',
+           'reset_detector_log', 'rotate_detector_log', 'merge_detector_logs',
+           'detach_detector_log']
 
 
 ## Globals for detector results logging
@@ -44,12 +47,69 @@ def detector_log(*args):
     logger.info(message)
 
 
+def detector_log_many(rows):
+    """Record many lines to the detector log file in a single write."""
+    if logger is None:
+        _configure_detector_logging()
+    if rows:
+        logger.info('\n'.join('\t'.join(str(arg) for arg in row)
+                               for row in rows))
+
+
 def reset_detector_log():
     if _log_path is not None and os.path.exists(_log_path):
         os.unlink(_log_path)
     _configure_detector_logging()
 
 
+def detach_detector_log():
+    """Forget the detector log file inherited from the parent process.
+
+    Forked workers call this first, so that they neither write to nor
+    rotate the file of the parent. Their next line goes to a file named
+    after their own pid.
+    """
+    global logger, _log_path
+    if logger is not None:
+        for handler in list(logger.handlers):
+            # closes the copy of the parent's file descriptor only
+            handler.close()
+            logger.removeHandler(handler)
+    logger = None
+    _log_path = None
+
+
+def rotate_detector_log():
+    """Close the detector log file of this process and return its path.
+
+    Lines logged afterwards go to a new file. Returns None if nothing was
+    logged. Worker processes use this to hand their results to a parent,
+    which merges them with merge_detector_logs.
+    """
+    global logger
+    if _log_path is None or not os.path.exists(_log_path):
+        return None
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+    path = '%s.%s' % (_log_path, uuid.uuid4())
+    os.rename(_log_path, path)
+    logger = None
+    return path
+
+
+def merge_detector_logs(paths):
+    """Append the detector log files at paths to the log of this process
+    and delete them, so one flush_detector_log_to_db loads them all."""
+    if logger is None:
+        _configure_detector_logging()
+    with open(_log_path, 'a') as log_file:
+        for path in paths:
+            with open(path) as _file:
+                shutil.copyfileobj(_file, log_file)
+            os.unlink(path)
+
+
 def flush_detector_log_to_db():
     from affine.model import (ImageDetectorResult, BoxDetectorResult, VideoDetectorResult,
                               TextDetectorResult, TextBoxResult)
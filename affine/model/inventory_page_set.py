@@ -0,0 +1,100 @@
+"""In-memory snapshot of the pages matched by web_pages.base_query.
+
+Coverage, QA and recall computations filter page ids against the inventory
+over and over. The snapshot loads the page ids once, sorted, with their
+impression counts, so those filters run in memory instead of as a DISTINCT
+join in MySQL. Snapshots are reloaded after affine.inventory_page_set.ttl
+seconds (config.cache_time() by default).
+"""
+import time
+
+import numpy as np
+
+from affine import config
+from affine.model.base import session
+from affine.model.videos import Video
+from affine.model.web_pages import WebPage, WebPageInventory, VideoOnPage
+
+__all__ = ['InventoryPageSet', 'get_inventory_page_set']
+
+
+class InventoryPageSet(object):
+    """Sorted page ids of the inventory with aligned impression counts"""
+
+    def __init__(self, page_ids, counts, join_to_videos=False):
+        order = np.argsort(page_ids, kind='mergesort')
+        self.page_ids = np.asarray(page_ids, dtype=np.int64)[order]
+        self.counts = np.asarray(counts, dtype=np.int64)[order]
+        self.join_to_videos = join_to_videos
+        self.loaded_at = time.time()
+
+    @classmethod
+    def load(cls, join_to_videos=False):
+        """Snapshot of base_query(join_to_videos=join_to_videos)"""
+        wpi = WebPageInventory
+        query = session.query(wpi.page_id, wpi.count)
+        query = query.join(WebPage, WebPage.id == wpi.page_id)
+        query = query.filter(WebPage.domain != 'set.tv')
+        if join_to_videos:
+            query = query.join(VideoOnPage, VideoOnPage.page_id == wpi.page_id)
+            query = query.filter(VideoOnPage.active == True,
+                                 VideoOnPage.is_preroll == False)
+            query = query.join(Video, Video.id == VideoOnPage.video_id)
+            query = query.distinct()
+        rows = query.all()
+        page_ids = [page_id for page_id, _ in rows]
+        counts = [count for _, count in rows]
+        return cls(page_ids, counts, join_to_videos)
+
+    def __len__(self):
+        return len(self.page_ids)
+
+    def __contains__(self, page_id):
+        pos = np.searchsorted(self.page_ids, page_id)
+        return pos < len(self.page_ids) and self.page_ids[pos] == page_id
+
+    def positions(self, page_ids):
+        """Index of every page id in the snapshot, -1 for missing pages"""
+        page_ids = np.asarray(page_ids, dtype=np.int64)
+        if not len(self.page_ids):
+            return np.full(len(page_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.page_ids, page_ids)
+        pos = np.minimum(pos, len(self.page_ids) - 1)
+        return np.where(self.page_ids[pos] == page_ids, pos, -1)
+
+    def contains(self, page_ids):
+        """Boolean mask of the page ids that are in the snapshot"""
+        return self.positions(page_ids) >= 0
+
+    def intersect(self, page_ids):
+        """Sorted array of the page ids that are in the snapshot"""
+        return np.intersect1d(self.page_ids,
+                              np.asarray(page_ids, dtype=np.int64))
+
+    def impressions(self, page_ids):
+        """Impression count of every page id, 0 for missing pages"""
+        pos = self.positions(page_ids)
+        if not len(self.page_ids):
+            return np.zeros(len(pos), dtype=np.int64)
+        return np.where(pos >= 0, self.counts[pos], 0)
+
+    @property
+    def total_impressions(self):
+        return int(self.counts.sum())
+
+    def age(self):
+        return time.time() - self.loaded_at
+
+
+_page_sets = {}
+
+
+def get_inventory_page_set(join_to_videos=False, ttl=None):
+    """Process-wide snapshot, reloaded once it is older than ttl seconds"""
+    if ttl is None:
+        ttl = config.get('affine.inventory_page_set.ttl', config.cache_time())
+    page_set = _page_sets.get(join_to_videos)
+    if page_set is None or page_set.age() >= ttl:
+        page_set = _page_sets[join_to_videos] = \
+            InventoryPageSet.load(join_to_videos)
+    return page_set
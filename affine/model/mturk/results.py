@@ -1,6 +1,7 @@
 from collections import defaultdict
 from datetime import datetime, timedelta
 from logging import getLogger
+import numpy as np
 from sqlalchemy.sql.expression import case
 import affine.aws.elasticache as elasticache
 from affine.model._sqla_imports import *
@@ -9,6 +10,7 @@ from affine.model.boxes import Box
 from affine.model.detection import AbstractTextDetector,\
     VideoDetectorResult, BoxDetectorResult, TextDetectorResult,\
     ImageDetectorResult, FaceRecognizeClassifier
+from affine.model.inventory_page_set import get_inventory_page_set
 from affine.model.labels import Label
 from affine.model.mturk.evaluators import VideoCollageEvaluator,\
     ClickableBoxEvaluator, WebPageTextEvaluator, ClickableImageEvaluator
@@ -597,13 +599,13 @@ class MTurkTextDetectorResult(Base, MTurkDetectorResultMixin):
     def results_to_qa(cls, min_date):
         """
         Find (max_hits_per_detector) text detector results since (min_date)
-        for QA-enabled detectors.
+        for QA-enabled detectors, pages with the most impressions first.
         """
-        tdr, wpi = TextDetectorResult, WebPageInventory
-        base_query = session.query(tdr).join(
+        tdr = TextDetectorResult
+        base_query = session.query(tdr.page_id).join(
             (WebPage, tdr.page_id == WebPage.id))
         base_query = base_query.filter(tdr.timestamp >= min_date)
-        base_query = base_query.outerjoin((wpi, wpi.page_id == tdr.page_id))
+        page_set = get_inventory_page_set()
 
         results = []
         for clf_target in cls.enabled_clf_targets():
@@ -613,11 +615,13 @@ class MTurkTextDetectorResult(Base, MTurkDetectorResultMixin):
                 PageHit, and_(PageHit.page_id == tdr.page_id,
                               PageHit.label_id == clf_target.target_label_id)).\
                 filter(PageHit.hit_id == None)
-            query = query.order_by(wpi.count.desc())
-            query = query.limit(clf_target.screenshot_count)
-            for inst in query:
+            page_ids = [page_id for (page_id,) in query]
+            # ordered by impressions in memory instead of joining the inventory
+            impressions = page_set.impressions(page_ids)
+            order = np.argsort(-impressions, kind='mergesort')
+            for i in order[:clf_target.screenshot_count]:
                 results.append((clf_target,
-                               inst.page_id,
+                               page_ids[i],
                                clf_target.clf.updated_at))
 
         return results
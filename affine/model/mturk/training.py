@@ -81,8 +81,10 @@ class TrainingJob(Base):
         # create BoxHits for all boxes and submit hits to Mturk
         boxes = []
         num_hits_submitted = 0
-        for url in session.query(VideoTrainingURL).filter_by(training_job_id = self.id, processed = False):
-            wpage = WebPage.by_url(url.url)
+        urls = session.query(VideoTrainingURL).filter_by(training_job_id = self.id, processed = False).all()
+        wpages = WebPage.by_urls([url.url for url in urls])
+        for url in urls:
+            wpage = wpages[url.url]
             if wpage is not None:
                 # get the video, and set url.processed only if video is updated on its face version
                 videos = sorted(wpage.active_videos, key=lambda x:x.length, reverse = True)
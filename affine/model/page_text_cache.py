@@ -0,0 +1,194 @@
+"""On-disk cache of page text shared by the processes on a host.
+
+Entries are files named <page_id>-<validator>, where the validator is the
+page's last_crawled_text to the second. WebPage.upload_page_text sets it
+to the upload time, and moves it on by a second on a re-upload within the
+same second, so once a recrawl is committed no host serves the old text.
+Reads touch the file, and when the cache grows past max_bytes the least
+recently used files are deleted.
+
+Objects stored under other S3 prefixes (page_text_processed) get a cache
+of their own in a subdirectory, bounded by the same max_bytes.
+
+Settings:
+    affine.page_text_cache.dir        cache directory
+    affine.page_text_cache.max_bytes  size bound, 0 disables the cache
+"""
+import errno
+import fcntl
+import os
+import tempfile
+import threading
+from logging import getLogger
+
+from affine import config
+
+__all__ = ['PageTextCache', 'page_text_cache']
+
+logger = getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+NUM_SUBDIRS = 256
+# Eviction deletes files until the cache is this fraction of max_bytes
+EVICT_TO_FRACTION = 0.9
+# A process checks the cache size after writing this fraction of max_bytes
+CHECK_SIZE_FRACTION = 0.01
+LOCK_FILE = '.lock'
+
+
+def _validator_str(validator):
+    if validator is None:
+        return '0'
+    if hasattr(validator, 'strftime'):
+        # DateTime columns store whole seconds, so a validator set in memory
+        # and the same one reloaded from the DB must give the same key
+        return validator.strftime('%Y%m%d%H%M%S')
+    return str(validator)
+
+
+class PageTextCache(object):
+    """Size-bounded LRU cache of raw page text files.
+
+    hits, misses and evictions count the cache operations of this process.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._bytes_since_check = 0
+        self._lock = threading.Lock()
+        for subdir in xrange(NUM_SUBDIRS):
+            config._ensure_dir_exists(os.path.join(directory, '%02x' % subdir))
+
+    def _subdir(self, page_id):
+        return os.path.join(self.directory, '%02x' % (page_id % NUM_SUBDIRS))
+
+    def _path(self, page_id, validator):
+        return os.path.join(self._subdir(page_id),
+                            '%d-%s' % (page_id, _validator_str(validator)))
+
+    def get(self, page_id, validator):
+        """Raw page text, or None if it is not cached for this validator"""
+        path = self._path(page_id, validator)
+        try:
+            with open(path, 'rb') as fi:
+                data = fi.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, page_id, validator, data):
+        self.invalidate(page_id)
+        subdir = self._subdir(page_id)
+        fd, tmp_path = tempfile.mkstemp(dir=subdir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fo:
+                fo.write(data)
+            os.rename(tmp_path, self._path(page_id, validator))
+        except (IOError, OSError):
+            logger.exception('Failed to cache page text for page %s', page_id)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._bytes_since_check += len(data)
+            check = self._bytes_since_check >= \
+                self.max_bytes * CHECK_SIZE_FRACTION
+            if check:
+                self._bytes_since_check = 0
+        if check:
+            self.evict()
+
+    def invalidate(self, page_id):
+        """Drops every cached version of a page's text"""
+        subdir = self._subdir(page_id)
+        prefix = '%d-' % page_id
+        for name in os.listdir(subdir):
+            if name.startswith(prefix):
+                try:
+                    os.unlink(os.path.join(subdir, name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def _entries(self):
+        for subdir in xrange(NUM_SUBDIRS):
+            subdir = os.path.join(self.directory, '%02x' % subdir)
+            for name in os.listdir(subdir):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Deletes the least recently used files if the cache is too big.
+
+        Only one process on the host evicts at a time, the others skip it.
+        """
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return 0
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return 0
+            target = self.max_bytes * EVICT_TO_FRACTION
+            num_evicted = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                num_evicted += 1
+        with self._lock:
+            self.evictions += num_evicted
+        if num_evicted:
+            logger.info('Evicted %d page text files', num_evicted)
+        return num_evicted
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+# S3 prefix -> PageTextCache
+_page_text_caches = {}
+
+
+def page_text_cache(prefix='page_text'):
+    """The configured cache of this process for the objects under prefix,
+    None if it is disabled"""
+    cache = _page_text_caches.get(prefix)
+    if cache is None:
+        max_bytes = int(config.get('affine.page_text_cache.max_bytes',
+                                   DEFAULT_MAX_BYTES))
+        if not max_bytes:
+            return None
+        directory = config.get('affine.page_text_cache.dir')
+        if directory is None:
+            directory = os.path.join(config.scratch_detector_path(),
+                                     'page_text_cache')
+        if prefix != 'page_text':
+            directory = os.path.join(directory, prefix)
+        cache = _page_text_caches[prefix] = PageTextCache(directory, max_bytes)
+    return cache
@@ -0,0 +1,72 @@
+"""Compression of the page text objects stored in S3.
+
+Compressed objects are recognized by the gzip or zstd magic bytes at the
+start of the object. Neither can start valid UTF-8 text, so objects
+uploaded as plain UTF-8 before compression was enabled stay readable.
+
+Settings:
+    affine.page_text.encoding  'gzip', 'zstd' or None for plain UTF-8
+"""
+import gzip
+import zlib
+from cStringIO import StringIO
+
+from affine import config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['encode_page_text', 'decode_page_text', 'page_text_encoding',
+           'upload_encoding']
+
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+ENCODINGS = (None, 'gzip', 'zstd')
+
+
+def page_text_encoding(data):
+    """Encoding of a stored page text object, None for plain UTF-8"""
+    if data.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if data.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def upload_encoding():
+    """Encoding configured for new uploads"""
+    encoding = config.get('affine.page_text.encoding') or None
+    assert encoding in ENCODINGS, 'Unknown page text encoding %s' % encoding
+    return encoding
+
+
+def encode_page_text(data, encoding):
+    """Compresses UTF-8 page text for upload"""
+    if encoding is None:
+        return data
+    if encoding == 'gzip':
+        buf = StringIO()
+        # mtime=0 keeps the output identical for identical text
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=GZIP_LEVEL,
+                           mtime=0) as fo:
+            fo.write(data)
+        return buf.getvalue()
+    if encoding == 'zstd':
+        assert zstandard is not None, 'zstandard is not installed'
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError('Unknown page text encoding %s' % encoding)
+
+
+def decode_page_text(data):
+    """UTF-8 page text from a stored object in any encoding"""
+    encoding = page_text_encoding(data)
+    if encoding is None:
+        return data
+    if encoding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    assert zstandard is not None, 'zstandard is not installed'
+    return zstandard.ZstdDecompressor().decompress(data)
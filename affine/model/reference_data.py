@@ -0,0 +1,171 @@
+"""Process-local snapshot of labels, classifiers and classifier targets.
+
+The text detectors look up the same few reference rows for every page they
+process. The snapshot loads all of them at once as plain tuples, indexed by
+id, name and (clf_id, target_label_id), so page processing does not query
+them. At most every affine.reference_data.check_interval seconds it checks
+whether any updated_at advanced or rows were added or removed, and it is
+reloaded when they did or once it is older than affine.reference_data.ttl
+seconds (config.cache_time() by default).
+"""
+import time
+from collections import defaultdict, namedtuple
+from logging import getLogger
+
+from affine import config
+from affine.model.base import session
+from affine.model._sqla_imports import func
+
+__all__ = ['ReferenceData', 'reference_data', 'clear_reference_data',
+           'reference_lookup']
+
+logger = getLogger(__name__)
+
+LabelRow = namedtuple('LabelRow', ['id', 'name', 'label_type'])
+ClassifierRow = namedtuple('ClassifierRow',
+                           ['id', 'name', 'cls', 'enabled_since', 'updated_at'])
+ClfTargetRow = namedtuple('ClfTargetRow', ['id', 'clf_id', 'target_label_id'])
+
+
+class ReferenceData(object):
+    """Labels, classifiers and classifier targets as of one load"""
+
+    def __init__(self, labels, classifiers, clf_targets, version=None):
+        self.version = version
+        self.loaded_at = self.checked_at = time.time()
+
+        self.labels = {row.id: row for row in labels}
+        # same labels as Label.by_name finds
+        self._labels_by_name = {row.name: row for row in labels
+                                if row.label_type != 'keywords'}
+
+        self.classifiers = {row.id: row for row in classifiers}
+        self._classifier_ids_by_cls = defaultdict(set)
+        for row in classifiers:
+            self._classifier_ids_by_cls[row.cls].add(row.id)
+
+        self.clf_targets = {row.id: row for row in clf_targets}
+        self._clf_targets_by_clf = defaultdict(list)
+        self._clf_targets_by_label = defaultdict(list)
+        self._clf_targets_by_key = {}
+        for row in clf_targets:
+            self._clf_targets_by_clf[row.clf_id].append(row)
+            self._clf_targets_by_label[row.target_label_id].append(row)
+            self._clf_targets_by_key[(row.clf_id, row.target_label_id)] = row
+
+    @classmethod
+    def current_version(cls):
+        """Changes whenever reference rows are added, removed or updated"""
+        from affine.model.classifier_target_labels import ClassifierTarget
+        from affine.model.detection import AbstractClassifier
+        from affine.model.labels import AbstractLabel
+        version = ()
+        for updated_at, id_column in [
+                (AbstractLabel.updated_at, AbstractLabel.id),
+                (AbstractClassifier.updated_at, AbstractClassifier.id),
+                (None, ClassifierTarget.id)]:
+            columns = [func.count(id_column), func.max(id_column)]
+            if updated_at is not None:
+                columns.append(func.max(updated_at))
+            version += tuple(session.query(*columns).one())
+        return version
+
+    @classmethod
+    def load(cls):
+        from affine.model.classifier_target_labels import ClassifierTarget
+        from affine.model.detection import AbstractClassifier
+        from affine.model.labels import Label
+        version = cls.current_version()
+        labels = [LabelRow(*row) for row in
+                  session.query(Label.id, Label.name, Label.label_type)]
+        ac = AbstractClassifier
+        classifiers = [ClassifierRow(*row) for row in
+                       session.query(ac.id, ac.name, ac._cls,
+                                     ac.enabled_since, ac.updated_at)]
+        ct = ClassifierTarget
+        clf_targets = [ClfTargetRow(*row) for row in
+                       session.query(ct.id, ct.clf_id, ct.target_label_id)]
+        logger.info('Loaded %d labels, %d classifiers and %d clf targets',
+                    len(labels), len(classifiers), len(clf_targets))
+        return cls(labels, classifiers, clf_targets, version)
+
+    def age(self):
+        return time.time() - self.loaded_at
+
+    def label(self, label_id):
+        return self.labels[label_id]
+
+    def label_by_name(self, name):
+        """Same label as Label.by_name, None if there is none"""
+        return self._labels_by_name.get(name)
+
+    def classifier_ids(self, clf_cls):
+        """Ids of the classifiers of clf_cls and its subclasses"""
+        ids = set()
+        for mapper in clf_cls.__mapper__.self_and_descendants:
+            ids.update(self._classifier_ids_by_cls.get(
+                mapper.polymorphic_identity, ()))
+        return ids
+
+    def classifier_of(self, clf_cls):
+        """The only classifier of clf_cls, like clf_cls.query.one()"""
+        ids = self.classifier_ids(clf_cls)
+        if len(ids) != 1:
+            raise KeyError('%d classifiers of type %s' %
+                           (len(ids), clf_cls.__name__))
+        return self.classifiers[ids.pop()]
+
+    def clf_targets_of(self, clf_id):
+        return self._clf_targets_by_clf.get(clf_id, [])
+
+    def clf_targets_with_label(self, target_label_id):
+        return self._clf_targets_by_label.get(target_label_id, [])
+
+    def clf_target(self, clf_id, target_label_id=None):
+        """Same clf target as clf.get_clf_target(target_label_id), or
+        clf.clf_target when target_label_id is not given"""
+        if target_label_id is not None:
+            return self._clf_targets_by_key[(clf_id, target_label_id)]
+        clf_targets = self.clf_targets_of(clf_id)
+        if len(clf_targets) != 1:
+            raise KeyError('Classifier %d has %d clf targets' %
+                           (clf_id, len(clf_targets)))
+        return clf_targets[0]
+
+
+_reference_data = None
+
+
+def reference_data(reload=False):
+    """Process-wide snapshot, reloaded when the reference tables change"""
+    global _reference_data
+    now = time.time()
+    ref = _reference_data
+    ttl = config.get('affine.reference_data.ttl', config.cache_time())
+    if reload or ref is None or ref.age() >= ttl:
+        ref = _reference_data = ReferenceData.load()
+    elif now - ref.checked_at >= config.get(
+            'affine.reference_data.check_interval', 60):
+        if ReferenceData.current_version() != ref.version:
+            ref = _reference_data = ReferenceData.load()
+        else:
+            ref.checked_at = now
+    return ref
+
+
+def clear_reference_data():
+    """Makes the next reference_data call reload the snapshot"""
+    global _reference_data
+    _reference_data = None
+
+
+def reference_lookup(lookup):
+    """Returns lookup(reference_data()).
+
+    If lookup raises KeyError the row may have been added since the snapshot
+    was loaded, so it is called once more on a freshly loaded snapshot.
+    """
+    try:
+        return lookup(reference_data())
+    except KeyError:
+        return lookup(reference_data(reload=True))
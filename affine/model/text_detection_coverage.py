@@ -0,0 +1,195 @@
+"""Coverage of all text detectors, kept up to date incrementally.
+
+AbstractTextDetector.get_coverage counts inventory pages whose
+text_detection_update is after the detector's last update, with two full
+scans per detector. This service keeps the text_detection_update of every
+inventory page in an array aligned to the inventory page set and per
+detector counters. Each refresh only reads the pages stamped since the last
+one, and a detector's counter is only recomputed when its updated_at moves.
+
+WebPage.new_crawl resets text_detection_update to NULL and stamps
+last_crawled_video, so each refresh also reads the pages with a NULL stamp
+crawled since the last one and clears them. Stamps are written by many
+hosts and can commit after a later stamp was read, so both reads go back
+affine.text_detection_coverage.reread_window seconds before their
+watermark; reading a page again does not change the counts. Everything is
+recomputed from scratch whenever the inventory page set is reloaded.
+"""
+import calendar
+from datetime import timedelta
+from logging import getLogger
+
+import numpy as np
+
+from affine import config
+from affine.model.base import session
+from affine.model._sqla_imports import func
+from affine.model.detection import AbstractTextDetector
+from affine.model.inventory_page_set import get_inventory_page_set
+from affine.model.web_pages import WebPage
+
+__all__ = ['TextDetectorCoverage', 'text_detector_coverage']
+
+logger = getLogger(__name__)
+
+# Seconds before the watermarks that every refresh reads again
+REREAD_WINDOW = 600
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class TextDetectorCoverage(object):
+    """Fraction of inventory pages every enabled text detector has run on"""
+
+    def __init__(self):
+        self.page_set = None
+        # text_detection_update of every page in page_set, NaN if it is NULL
+        self.update_times = None
+        self.watermark = None
+        # last_crawled_video up to which reset stamps have been read
+        self.reset_watermark = None
+        self.num_updated = 0
+        # detector id -> (threshold, number of pages updated after it)
+        self.detectors = {}
+
+    def _read_page_set(self):
+        return get_inventory_page_set()
+
+    def _read_last_crawl(self):
+        return session.query(func.max(WebPage.last_crawled_video)).scalar()
+
+    def _read_stamps(self, since=None):
+        """(page_id, text_detection_update) of the inventory pages with a
+        stamp, only those stamped at or after since if it is given"""
+        query = session.query(WebPage.id, WebPage.text_detection_update)
+        if since is None:
+            query = query.filter(WebPage.text_detection_update != None)
+            query = query.join(WebPage.inventory)
+        else:
+            query = query.filter(WebPage.text_detection_update >= since)
+        return query.all()
+
+    def _read_resets(self, since=None):
+        """(page_id, last_crawled_video) of the crawled pages without a
+        stamp, only those crawled at or after since if it is given"""
+        query = session.query(WebPage.id, WebPage.last_crawled_video)
+        query = query.filter(WebPage.text_detection_update == None)
+        if since is None:
+            query = query.filter(WebPage.last_crawled_video != None)
+        else:
+            query = query.filter(WebPage.last_crawled_video >= since)
+        return query.all()
+
+    def _read_thresholds(self):
+        """Dict mapping enabled detector ids to the time their results
+        became current"""
+        query = AbstractTextDetector.query.filter(
+            AbstractTextDetector.enabled_since != None)
+        return {det.id: _timestamp(max(det.enabled_since, det.updated_at))
+                for det in query}
+
+    def _load_update_times(self):
+        # read first, so that pages reset during the load are cleared later
+        self.reset_watermark = self._read_last_crawl()
+        self.update_times = np.full(len(self.page_set), np.nan)
+        self._apply(self._read_stamps())
+        self.num_updated = int(np.count_nonzero(~np.isnan(self.update_times)))
+        self.detectors = {}
+
+    def _apply(self, rows):
+        """Sets the update times of rows, returns (positions, old times)"""
+        rows = [(page_id, dt) for page_id, dt in rows if dt is not None]
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        pos = self.page_set.positions([page_id for page_id, _ in rows])
+        times = np.array([_timestamp(dt) for _, dt in rows])
+        in_set = pos >= 0
+        pos, times = pos[in_set], times[in_set]
+        old_times = self.update_times[pos]
+        self.update_times[pos] = times
+        watermark = max(dt for _, dt in rows)
+        if self.watermark is None or watermark > self.watermark:
+            self.watermark = watermark
+        return pos, old_times
+
+    def _clear(self, rows):
+        """Clears the update times of (page_id, last_crawled_video) rows,
+        returns (positions, old times)"""
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        pos = self.page_set.positions([page_id for page_id, _ in rows])
+        pos = pos[pos >= 0]
+        old_times = self.update_times[pos]
+        self.update_times[pos] = np.nan
+        reset_watermark = max(dt for _, dt in rows)
+        if self.reset_watermark is None or \
+                reset_watermark > self.reset_watermark:
+            self.reset_watermark = reset_watermark
+        return pos, old_times
+
+    def _update_counts(self, old_times, new_times):
+        # NaN compares False, so pages new to a count add one and cleared
+        # pages remove one
+        self.num_updated += int(np.count_nonzero(~np.isnan(new_times)) -
+                                np.count_nonzero(~np.isnan(old_times)))
+        for det_id, (threshold, count) in self.detectors.items():
+            count += int(np.count_nonzero(new_times > threshold) -
+                         np.count_nonzero(old_times > threshold))
+            self.detectors[det_id] = (threshold, count)
+
+    def refresh(self):
+        """Reads the pages stamped since the last refresh"""
+        page_set = self._read_page_set()
+        if page_set is not self.page_set:
+            logger.info('Recomputing text detector coverage')
+            self.page_set = page_set
+            self.watermark = None
+            self._load_update_times()
+        elif self.watermark is not None:
+            window = timedelta(seconds=config.get(
+                'affine.text_detection_coverage.reread_window', REREAD_WINDOW))
+            pos, old_times = self._apply(
+                self._read_stamps(self.watermark - window))
+            self._update_counts(old_times, self.update_times[pos])
+
+            since = self.reset_watermark
+            if since is not None:
+                since -= window
+            pos, old_times = self._clear(self._read_resets(since))
+            self._update_counts(old_times, self.update_times[pos])
+        else:
+            self._load_update_times()
+
+        enabled = self._read_thresholds()
+        for det_id in set(self.detectors) - set(enabled):
+            del self.detectors[det_id]
+        for det_id, threshold in enabled.iteritems():
+            if self.detectors.get(det_id, (None,))[0] != threshold:
+                count = int(np.count_nonzero(self.update_times > threshold))
+                self.detectors[det_id] = (threshold, count)
+
+    def coverage(self, detector_ids=None):
+        """Dict mapping the id of every enabled detector to its coverage"""
+        self.refresh()
+        if detector_ids is None:
+            detector_ids = self.detectors.keys()
+        result = {}
+        for det_id in detector_ids:
+            assert det_id in self.detectors, 'Detector is not enabled'
+            _, count = self.detectors[det_id]
+            result[det_id] = count / float(self.num_updated) \
+                if self.num_updated else 0.0
+        return result
+
+
+_coverage = None
+
+
+def text_detector_coverage():
+    """Process-wide coverage service"""
+    global _coverage
+    if _coverage is None:
+        _coverage = TextDetectorCoverage()
+    return _coverage
@@ -1,3 +1,6 @@
+import csv
+import tempfile
+from collections import defaultdict
 from datetime import datetime
 
 from affine.model.base import *
@@ -6,6 +9,13 @@ from affine.model.secondary_tables import bundle_keywords_table
 
 __all__ = ['UserKeyword', 'KeywordBundle', 'WebPageUserKeywordResult']
 
+# Page ids per query when reading existing results
+RESULTS_QUERY_CHUNK_SIZE = 1000
+# Rows per multi-row insert or tuple IN delete statement
+RESULTS_WRITE_CHUNK_SIZE = 5000
+# Larger inserts go through LOAD DATA instead of multi-row VALUES
+LOAD_DATA_MIN_ROWS = 50000
+
 
 class UserKeyword(Base):
     __tablename__ = 'user_keywords'
@@ -79,3 +89,58 @@ class WebPageUserKeywordResult(Base):
         """Expects a file with tab separated fields matching the schema of WebPageUserKeywordResults"""
         cols = 'page_id, user_keyword_id'
         cls._load_from_file(wpukr_file, cols, on_duplicate)
+
+    @classmethod
+    def reconcile_results(cls, page_results, user_keyword_ids=None):
+        """Makes the stored results of many pages match their new hits.
+
+        page_results maps page_id to the set of user_keyword_ids now found on
+        the page. Missing rows are inserted and rows for keywords that are no
+        longer on the page are deleted, in a few bulk statements for all pages.
+        If user_keyword_ids is given, only rows for those keywords are touched.
+        Returns (num_inserted, num_deleted).
+        """
+        page_ids = list(page_results)
+        to_insert, to_delete = [], []
+        for i in xrange(0, len(page_ids), RESULTS_QUERY_CHUNK_SIZE):
+            id_chunk = page_ids[i:i + RESULTS_QUERY_CHUNK_SIZE]
+            existing = defaultdict(set)
+            query = session.query(cls.page_id, cls.user_keyword_id)
+            query = query.filter(cls.page_id.in_(id_chunk))
+            if user_keyword_ids is not None:
+                query = query.filter(cls.user_keyword_id.in_(user_keyword_ids))
+            for page_id, user_keyword_id in query:
+                existing[page_id].add(user_keyword_id)
+            for page_id in id_chunk:
+                new_ids = set(page_results[page_id])
+                old_ids = existing[page_id]
+                to_insert.extend((page_id, uk_id) for uk_id in new_ids - old_ids)
+                to_delete.extend((page_id, uk_id) for uk_id in old_ids - new_ids)
+        cls._delete_rows(to_delete)
+        cls._insert_rows(to_insert)
+        return len(to_insert), len(to_delete)
+
+    @classmethod
+    def _delete_rows(cls, rows):
+        columns = tuple_(cls.page_id, cls.user_keyword_id)
+        for i in xrange(0, len(rows), RESULTS_WRITE_CHUNK_SIZE):
+            row_chunk = rows[i:i + RESULTS_WRITE_CHUNK_SIZE]
+            cls.query.filter(columns.in_(row_chunk)).delete(
+                synchronize_session=False)
+
+    @classmethod
+    def _insert_rows(cls, rows):
+        if len(rows) >= LOAD_DATA_MIN_ROWS:
+            with tempfile.NamedTemporaryFile() as wpukr_file:
+                writer = csv.writer(wpukr_file, delimiter='\t')
+                writer.writerows(rows)
+                wpukr_file.flush()
+                cls.load_from_file(wpukr_file.name)
+            return
+        cols = 'page_id, user_keyword_id'
+        for i in xrange(0, len(rows), RESULTS_WRITE_CHUNK_SIZE):
+            values = ', '.join('(%d, %d)' % row
+                               for row in rows[i:i + RESULTS_WRITE_CHUNK_SIZE])
+            execute("""
+                insert ignore into %s (%s)
+                    values %s""" % (cls.__tablename__, cols, values))
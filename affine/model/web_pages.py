@@ -1,28 +1,55 @@
 """Web pages that our VCR has visited. They may have videos."""
 import csv
+import os
 import tempfile
+import threading
 
-from collections import defaultdict
+from collections import deque
 from hashlib import sha1
-from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from datetime import datetime, timedelta
 
 from sqlalchemy.ext.hybrid import hybrid_property
 import sqlalchemy.types as types
 import affine.normalize_url as normalize
 
 from sqlalchemy import event
-from affine.model.labels import Keyword, WeightedKeyword
 from affine.aws import s3client
 from affine.model.videos import Video
 from affine import config
 from affine.model.base import *
 from affine.model.load_data_infile import load_data_infile
+from affine.model.page_text_cache import page_text_cache
+from affine.model.page_text_encoding import encode_page_text, \
+    decode_page_text, page_text_encoding, upload_encoding
 from affine.model.secondary_tables import *
 from affine.model._sqla_imports import *
 from affine.retries import retry_operation
 from affine.video_processing import resize_image, convert_png_to_jpeg
 
-__all__ = ['WebPage', 'VideoOnPage', 'WebPageInventory', 'DumpFromInfoBright', 'base_query']
+__all__ = ['WebPage', 'VideoOnPage', 'WebPageInventory', 'DumpFromInfoBright', 'base_query',
+           'PageTextFetcher', 'iter_page_texts', 'iter_raw_page_texts',
+           'put_page_text_object']
+
+# Urls per query when looking pages up by remote_id_sha1
+URL_QUERY_CHUNK_SIZE = 1000
+# First line of a stored processed text artifact
+PROCESSED_TEXT_MARKER = 'processed_text %d\n'
+# Concurrent page text downloads
+PAGE_TEXT_FETCH_THREADS = 16
+PAGE_TEXT_FETCH_TRIES = 3
+PAGE_TEXT_RETRY_SLEEP = 1  # seconds
+# Bound on the (page id, last_crawled_text) pairs remembered to have no
+# current processed text artifact
+MISSING_PROCESSED_TEXT_LIMIT = 100000
+
+_missing_processed_texts = set()
+
+
+def _remember_missing_processed_text(key):
+    if len(_missing_processed_texts) >= MISSING_PROCESSED_TEXT_LIMIT:
+        _missing_processed_texts.clear()
+    _missing_processed_texts.add(key)
 
 
 class ListOfStrings(types.TypeDecorator):
@@ -49,7 +76,7 @@ class WebPage(Base):
     s3_favicon = Column(Boolean, nullable=False, default=False)
     title = Column(UnicodeText, nullable=False, default=u'')
     processed_title = Column(ListOfStrings, default=u'')
-    last_crawled_text = Column(DateTime, nullable=False, default=datetime.utcnow())
+    last_crawled_text = Column(DateTime, nullable=False, default=datetime.utcnow)
     last_crawled_video = Column(DateTime, nullable=True, default=None)
     change_count = Column(Integer, nullable=False, default=0)
     crawl_count = Column(Integer, nullable=False, default=0)
@@ -84,8 +111,59 @@ class WebPage(Base):
     @classmethod
     def by_url(cls, url, session=session):
         remote_id = normalize.parse_url(url)
-        obj = session.query(cls).filter_by(remote_id=remote_id).first()
-        return obj
+        return cls._by_remote_ids({remote_id}, session).get(remote_id)
+
+    @classmethod
+    def by_urls(cls, urls, session=session):
+        """Looks up many urls at once. Returns a dict mapping each url to its
+        page, or to None if there is no page for the url.
+        """
+        remote_ids = {url: normalize.parse_url(url) for url in set(urls)}
+        pages = cls._by_remote_ids(set(remote_ids.itervalues()), session)
+        return {url: pages.get(remote_id)
+                for url, remote_id in remote_ids.iteritems()}
+
+    @classmethod
+    def _by_remote_ids(cls, remote_ids, session=session):
+        """Dict mapping normalized urls to their pages, found by url hash.
+
+        remote_id_sha1 has no unique key, so a url can have several pages;
+        the one with the lowest id is returned, as every caller agrees on it.
+        """
+        sha1s = [sha1(remote_id).hexdigest() for remote_id in remote_ids]
+        pages = {}
+        for i in xrange(0, len(sha1s), URL_QUERY_CHUNK_SIZE):
+            query = session.query(cls).filter(
+                cls.remote_id_sha1.in_(sha1s[i:i + URL_QUERY_CHUNK_SIZE]))
+            for page in query:
+                if page.remote_id not in remote_ids:
+                    continue
+                other = pages.get(page.remote_id)
+                if other is None or page.id < other.id:
+                    pages[page.remote_id] = page
+        return pages
+
+    @classmethod
+    def get_or_create_many(cls, urls):
+        """Pages for many urls, creating the missing ones in one insert.
+        Returns a dict mapping each url to its page.
+
+        Nothing stops another process from creating the same pages at the
+        same time. Both then read the pages back and use the one with the
+        lowest id, but the duplicate rows stay in the table.
+        """
+        session.flush()
+        remote_ids = {url: normalize.parse_url(url) for url in set(urls)}
+        pages = cls._by_remote_ids(set(remote_ids.itervalues()))
+        missing = set(remote_ids.itervalues()) - set(pages)
+        if missing:
+            rows = [{'remote_id': remote_id,
+                     'remote_id_sha1': sha1(remote_id).hexdigest(),
+                     'domain': normalize.domain_of_url(remote_id)}
+                    for remote_id in missing]
+            execute(cls.__table__.insert(), rows)
+            pages.update(cls._by_remote_ids(missing))
+        return {url: pages[remote_id] for url, remote_id in remote_ids.iteritems()}
 
     @property
     def prerolls(self):
@@ -95,49 +173,63 @@ class WebPage(Base):
         """We have just visited this page and found the given videos and prerolls.
         The videos passed in should be unique (no duplicates).
         """
+        # make sure new videos have ids
+        session.flush()
+        crawled = {}
+        for (is_preroll, video_list) in [(False, videos), (True, prerolls or [])]:
+            for video, stream_url, is_autoplay, player_width, player_height, player_top, player_left in video_list:
+                crawled_video = crawled.get(video.id)
+                if crawled_video is None:
+                    crawled_video = crawled[video.id] = {
+                        'video_id': video.id, 'seen_count': 0}
+                crawled_video.update(
+                    active=not is_preroll, is_preroll=is_preroll,
+                    stream_url=stream_url, is_autoplay=is_autoplay,
+                    player_width=player_width, player_height=player_height,
+                    player_top=player_top, player_left=player_left)
+                crawled_video['seen_count'] += 1
+
         update_args = {
             'last_crawled_video': datetime.utcnow(),
             'crawl_count': WebPage.crawl_count + 1,
             'text_detection_update': None,
         }
         if self.crawl_count:
-            active_videos = [
-                video for (video, stream_url, is_autoplay, width, height, top, left) in videos]
-            if set(active_videos) != set(self.active_videos):
+            active_video_ids = {
+                video.id for (video, stream_url, is_autoplay, width, height, top, left) in videos}
+            query = session.query(VideoOnPage.video_id).filter_by(
+                page_id=self.id, active=True, is_preroll=False)
+            if active_video_ids != {video_id for (video_id,) in query}:
                 update_args['change_count'] = WebPage.change_count + 1
         query = WebPage.query.filter_by(id=self.id)
         retry_operation(query.update, update_args)
 
-        for crawled_video in self.crawled_videos:
-            crawled_video.active = False
-        for (is_preroll, video_list) in [(False, videos), (True, prerolls or [])]:
-            for video, stream_url, is_autoplay, player_width, player_height, player_top, player_left in video_list:
-                crawled_video = None
-                for old_crawled_video in self.crawled_videos:
-                    if old_crawled_video.video == video:
-                        crawled_video = old_crawled_video
-                        break
-                if crawled_video is None:
-                    crawled_video = VideoOnPage(
-                        page=self, video=video, seen_count=0)
-                crawled_video.active = not is_preroll
-                crawled_video.is_preroll = is_preroll
-                crawled_video.seen_count += 1
-                crawled_video.stream_url = stream_url
-                crawled_video.is_autoplay = is_autoplay
-                crawled_video.player_width = player_width
-                crawled_video.player_height = player_height
-                crawled_video.player_left = player_left
-                crawled_video.player_top = player_top
+        query = VideoOnPage.query.filter_by(page_id=self.id, active=True)
+        if crawled:
+            query = query.filter(~VideoOnPage.video_id.in_(crawled.keys()))
+        query.update({'active': False}, synchronize_session=False)
+        if crawled:
+            VideoOnPage.upsert_many(self.id, crawled.values())
 
-        session.flush()
+        # the bulk statements bypassed the ORM, so reload the videos on access
+        for crawled_video in self.__dict__.get('crawled_videos', ()):
+            session.expire(crawled_video)
+        session.expire(self, ['crawled_videos'])
 
     @classmethod
     def get_or_create(cls, remote_id):
+        """Page for a url, created if there is none.
+
+        Another process may create the same page at the same time, so a new
+        page is read back and the one with the lowest id is returned, as
+        _by_remote_ids does.
+        """
         remote_id = normalize.parse_url(remote_id)
-        page = (cls.query.filter_by(remote_id=remote_id).first() or
-                cls(remote_id=remote_id))
-        session.flush()
+        page = cls._by_remote_ids({remote_id}, session).get(remote_id)
+        if page is None:
+            cls(remote_id=remote_id)
+            session.flush()
+            page = cls._by_remote_ids({remote_id}, session)[remote_id]
         return page
 
     @property
@@ -146,12 +238,39 @@ class WebPage(Base):
 
     @property
     def processed_description_text(self):
+        if self.s3_page_text:
+            tokens = self.get_processed_text()
+            if tokens is not None:
+                return tokens
         text = self.get_page_text()
         from affine.detection.nlp.keywords.keyword_matching import process_text
         if text is not None:
             return process_text(text)
         return None
 
+    def get_processed_text(self):
+        """Tokens of the stored processed text, None if there is no artifact
+        for the current page text.
+
+        Pages found without one are remembered until their text is uploaded
+        again, so they only cost the raw text download afterwards.
+        """
+        key = (self.id, self.last_crawled_text)
+        if key in _missing_processed_texts:
+            return None
+        cache = page_text_cache('page_text_processed')
+        data = None
+        if cache is not None:
+            data = cache.get(self.id, self.last_crawled_text)
+        if data is None:
+            data = _fetcher('page_text_processed').fetch(self.id)
+            if data is not None and cache is not None:
+                cache.put(self.id, self.last_crawled_text, data)
+        tokens = decode_processed_text(data) if data is not None else None
+        if tokens is None:
+            _remember_missing_processed_text(key)
+        return tokens
+
     @description_text.setter
     def description_text(self, text):
         self.upload_page_text(text)
@@ -192,10 +311,17 @@ class WebPage(Base):
 
     def get_page_text(self):
         if self.s3_page_text:
-            bucket = config.s3_bucket()
-            urlpath = "%s/%s" % ('page_text', self.id)
-            text = s3client.download_from_s3_as_string(bucket, urlpath)
-            return text.decode('utf-8')
+            cache = page_text_cache()
+            text = None
+            if cache is not None:
+                text = cache.get(self.id, self.last_crawled_text)
+            if text is None:
+                bucket = config.s3_bucket()
+                urlpath = "%s/%s" % ('page_text', self.id)
+                text = s3client.download_from_s3_as_string(bucket, urlpath)
+                if cache is not None:
+                    cache.put(self.id, self.last_crawled_text, text)
+            return decode_page_text(text).decode('utf-8')
         return None
 
     def upload_screenshot(self, path):
@@ -219,10 +345,40 @@ class WebPage(Base):
         s3client.upload_to_s3(bucket, urlpath, path, public=True)
 
     def upload_page_text(self, text):
+        from affine.detection.nlp.keywords.keyword_matching import process_text
         bucket = config.s3_bucket()
         urlpath = "%s/%s" % ('page_text', self.id)
-        text = text.encode('utf-8')
-        s3client.upload_to_s3_from_string(bucket, urlpath, text, public=True)
+        processed_text = process_text(text)
+        text = encode_page_text(text.encode('utf-8'), upload_encoding())
+        # A stale artifact must not outlive the text it was made from, so
+        # it is gone before the new text lands. If the new artifact fails to
+        # upload, readers fall back to processing the raw text.
+        bucket_conn = s3client.connect(bucket)
+        bucket_conn.delete_key("%s/%s" % ('page_text_processed', self.id))
+        put_page_text_object(bucket_conn, urlpath, text)
+        # validates the text cached on other hosts, see page_text_cache. The
+        # column stores whole seconds, so a second upload within the same
+        # second moves it on by one to still invalidate the old text.
+        crawled = datetime.utcnow().replace(microsecond=0)
+        if self.last_crawled_text is not None and \
+                crawled <= self.last_crawled_text:
+            crawled = self.last_crawled_text.replace(microsecond=0) + \
+                timedelta(seconds=1)
+        self.last_crawled_text = crawled
+        self.upload_processed_text(processed_text)
+        cache = page_text_cache()
+        if cache is not None:
+            cache.invalidate(self.id)
+
+    def upload_processed_text(self, tokens):
+        """Stores the process_text output of the page text next to it"""
+        bucket = config.s3_bucket()
+        urlpath = "%s/%s" % ('page_text_processed', self.id)
+        data = encode_page_text(encode_processed_text(tokens), upload_encoding())
+        put_page_text_object(s3client.connect(bucket), urlpath, data)
+        cache = page_text_cache('page_text_processed')
+        if cache is not None:
+            cache.invalidate(self.id)
 
     def upload_favicon(self, path):
         bucket = config.s3_bucket()
@@ -258,26 +414,23 @@ class WebPage(Base):
 
     def keyword_results(self, label_id):
         """ get list of keywords present on the web page that fired the label"""
-        from affine.detection.nlp.keywords.keyword_matching import \
-                PageKeywordMatcher
-        body_matcher = PageKeywordMatcher()
-        title_matcher = PageKeywordMatcher()
-        weighted_keywords = session.\
-            query(Keyword.text, WeightedKeyword.title_weight,
-                  WeightedKeyword.body_weight).\
-            join(WeightedKeyword).filter_by(label_id=label_id)
-        for kw_text, title_weight, body_weight in weighted_keywords:
-            title_matcher.add_keyword((kw_text, title_weight), kw_text)
-            body_matcher.add_keyword((kw_text, body_weight), kw_text)
-        matches = defaultdict(int)
-        for kw_text, title_weight in title_matcher.matching_keywords(
-                self.processed_title):
-            matches[kw_text] = title_weight
-        for kw_text, body_weight in body_matcher.matching_keywords(
-                self.processed_description_text):
-            if kw_text not in matches or matches[kw_text] == 0:
-                matches[kw_text] = body_weight
-        return matches.items()
+        return self.keyword_results_for_labels([label_id]).get(label_id, [])
+
+    def keyword_results_for_labels(self, label_ids=None):
+        """ get keywords present on the web page for many labels in one scan.
+        Returns a dict mapping label_id to a list of (keyword text, weight)
+
+        Uses the compiled keyword index when it is current, and otherwise the
+        live matchers of the process, which keyword edits are patched into.
+        """
+        from affine.detection.nlp.keywords.keyword_index import \
+                current_keyword_index
+        index = current_keyword_index()
+        if index is not None:
+            return index.score_page(self, label_ids)
+        from affine.detection.nlp.keywords.index_refresher import \
+                keyword_index_refresher
+        return keyword_index_refresher().score_page(self, label_ids)
 
 
 # Cascade and set domain, sha1 when the remote_id is set/ updated
@@ -312,6 +465,34 @@ class VideoOnPage(Base):
     __table_args__ = (
         UniqueConstraint('video_id', 'page_id', name='ix_video_id_page_id'), {})
 
+    _UPSERT_COLUMNS = ['video_id', 'active', 'is_preroll', 'seen_count',
+                       'stream_url', 'is_autoplay', 'player_width',
+                       'player_height', 'player_top', 'player_left']
+
+    @classmethod
+    def upsert_many(cls, page_id, crawled_videos):
+        """Inserts or updates the rows for many videos on a page at once.
+
+        crawled_videos are dicts with a value for every column in
+        _UPSERT_COLUMNS. seen_count is added to the count of existing rows.
+        """
+        params = {'page_id': page_id}
+        values = []
+        for i, crawled_video in enumerate(crawled_videos):
+            for col in cls._UPSERT_COLUMNS:
+                params['%s_%d' % (col, i)] = crawled_video[col]
+            values.append('(:page_id, %s)' % ', '.join(
+                ':%s_%d' % (col, i) for col in cls._UPSERT_COLUMNS))
+        updates = ['%s = values(%s)' % (col, col)
+                   for col in cls._UPSERT_COLUMNS if col != 'seen_count']
+        updates.append('seen_count = seen_count + values(seen_count)')
+        execute("""
+            insert into %s (page_id, %s)
+                values %s
+                on duplicate key update %s""" %
+            (cls.__tablename__, ', '.join(cls._UPSERT_COLUMNS),
+             ', '.join(values), ', '.join(updates)), params)
+
     @classmethod
     def get_or_create(cls, video_id, page_id):
         # Persist any unflushed changed so they don't get lost if we hit an
@@ -387,6 +568,166 @@ def base_query(join_to_videos=False, join_to_inventory=True):
     return query
 
 
+def encode_processed_text(tokens):
+    """Processed text artifact: a version marker, then one token per line"""
+    from affine.detection.nlp.keywords.normalization import \
+        PROCESSED_TEXT_VERSION
+    marker = PROCESSED_TEXT_MARKER % PROCESSED_TEXT_VERSION
+    return marker + '\n'.join(tokens).encode('utf-8')
+
+
+def decode_processed_text(data):
+    """Tokens of a stored artifact, None if it is from another version"""
+    from affine.detection.nlp.keywords.normalization import \
+        PROCESSED_TEXT_VERSION
+    marker = PROCESSED_TEXT_MARKER % PROCESSED_TEXT_VERSION
+    data = decode_page_text(data)
+    if not data.startswith(marker):
+        return None
+    data = data[len(marker):]
+    return data.decode('utf-8').split('\n') if data else []
+
+
+def put_page_text_object(bucket_conn, urlpath, data):
+    """Uploads a publicly readable page text object.
+
+    Compressed objects get a Content-Encoding header, so HTTP clients of
+    s3_page_text_url decompress them. Readers through the S3 API still get
+    the stored bytes.
+    """
+    headers = {}
+    encoding = page_text_encoding(data)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    def upload():
+        key = bucket_conn.new_key(urlpath)
+        key.set_contents_from_string(data, headers=headers,
+                                     policy='public-read')
+    retry_operation(upload, error_class=Exception,
+                    num_tries=PAGE_TEXT_FETCH_TRIES,
+                    sleep_time=PAGE_TEXT_RETRY_SLEEP,
+                    error_message='Page text upload failed: %s' % urlpath,
+                    raise_exception=True, with_traceback=False)
+
+
+class PageTextFetcher(object):
+    """Downloads page text from S3 with a pool of threads.
+
+    Each thread keeps its own connection for the life of the fetcher. At most
+    max_in_flight downloads are queued at once and results come back in the
+    order of the page ids, so arbitrarily long id lists can be streamed.
+    connect is called once per thread to open a connection, which only needs
+    a get_key method; by default it connects to the configured bucket.
+    Objects are read from <prefix>/<page_id>.
+    """
+
+    def __init__(self, num_threads=PAGE_TEXT_FETCH_THREADS, connect=None,
+                 max_in_flight=None, num_tries=PAGE_TEXT_FETCH_TRIES,
+                 sleep_time=PAGE_TEXT_RETRY_SLEEP, prefix='page_text'):
+        self.prefix = prefix
+        self.num_threads = num_threads
+        self.connect = connect or (lambda: s3client.connect(config.s3_bucket()))
+        self.max_in_flight = max_in_flight or 4 * num_threads
+        self.num_tries = num_tries
+        self.sleep_time = sleep_time
+        self._local = threading.local()
+        self._pool = None
+        self._pool_pid = None
+
+    def _connection(self):
+        try:
+            return self._local.conn
+        except AttributeError:
+            self._local.conn = self.connect()
+            return self._local.conn
+
+    def _download(self, page_id):
+        """Raw page text, or None if there is no page text for the page"""
+        urlpath = "%s/%s" % (self.prefix, page_id)
+        def download():
+            key = self._connection().get_key(urlpath)
+            if key is None:
+                return None
+            return key.get_contents_as_string()
+        return retry_operation(download, error_class=Exception,
+                               num_tries=self.num_tries,
+                               sleep_time=self.sleep_time,
+                               error_message='Page text download failed: %s' % urlpath,
+                               raise_exception=True, with_traceback=False)
+
+    def fetch(self, page_id):
+        """Raw object of one page on the connection of the calling thread,
+        None if there is none"""
+        return self._download(page_id)
+
+    def _get_pool(self):
+        # threads do not survive a fork, so children start their own pool
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPool(self.num_threads)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def iter_raw_page_texts(self, page_ids):
+        """Yields (page_id, stored object) in the order of page_ids.
+
+        The object is None for page ids without page text.
+        """
+        pool = self._get_pool()
+        in_flight = deque()
+        page_ids = iter(page_ids)
+        while True:
+            for page_id in page_ids:
+                in_flight.append(
+                    (page_id, pool.apply_async(self._download, (page_id,))))
+                if len(in_flight) >= self.max_in_flight:
+                    break
+            if not in_flight:
+                return
+            page_id, result = in_flight.popleft()
+            yield page_id, result.get()
+
+    def iter_page_texts(self, page_ids, silent=False):
+        """Yields (page_id, page_text) in the order of page_ids.
+
+        Page ids without page text get empty text if silent is set and raise
+        AttributeError otherwise, as in get_page_text_dict.
+        """
+        for page_id, text in self.iter_raw_page_texts(page_ids):
+            if text is None:
+                if not silent:
+                    raise AttributeError('No page text for page %s' % page_id)
+                yield page_id, ""
+            else:
+                yield page_id, decode_page_text(text).decode('utf-8')
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+
+
+_fetchers = {}
+
+
+def _fetcher(prefix):
+    fetcher = _fetchers.get(prefix)
+    if fetcher is None:
+        fetcher = _fetchers[prefix] = PageTextFetcher(prefix=prefix)
+    return fetcher
+
+
+def iter_page_texts(page_ids, silent=False):
+    """Streams (page_id, page_text) for page_ids in order, see PageTextFetcher"""
+    return _fetcher('page_text').iter_page_texts(page_ids, silent=silent)
+
+
+def iter_raw_page_texts(page_ids):
+    """Streams (page_id, stored page text) for page_ids in order, None for
+    pages without page text"""
+    return _fetcher('page_text').iter_raw_page_texts(page_ids)
+
+
 def get_page_text_dict(page_ids, silent=False):
     """
     Retrieves page_text for given page_ids.
@@ -395,21 +736,7 @@ def get_page_text_dict(page_ids, silent=False):
             empty text for non-existent page_ids.
     :return: dictionary with mapping page_id -> page_text.
     """
-    page_ids = set(page_ids)
-    output = {page_id: "" for page_id in page_ids}
-    bucket = config.s3_bucket()
-    s3_conn = s3client.connect(bucket)
-
-    for page_id in page_ids:
-        urlpath = "%s/%s" % ('page_text', page_id)
-        try:
-            text = s3_conn.get_key(urlpath).get_contents_as_string()
-            output[page_id] = text.decode('utf-8')
-        except AttributeError as e:
-            if not silent:
-                raise e
-
-    return output
+    return dict(iter_page_texts(set(page_ids), silent=silent))
 
 
 def get_page_processed_text_dict(page_ids, silent=False):
@@ -420,9 +747,30 @@ def get_page_processed_text_dict(page_ids, silent=False):
             empty text for non-existent page_ids.
     :return: dictionary with mapping page_id -> processed_text.
     """
-    from affine.detection.nlp.keywords.keyword_matching import process_text
-    output = get_page_text_dict(page_ids, silent=silent)
-    for page_id, page_text in output.iteritems():
-        if page_text is not None:
-            output[page_id] = process_text(page_text)
+    from affine.detection.nlp.keywords.keyword_matching import process_texts
+    page_ids = set(page_ids)
+    # pages known to have no artifact for their current text, as in
+    # WebPage.get_processed_text, skip the artifact download
+    validators = {}
+    page_id_list = list(page_ids)
+    for i in xrange(0, len(page_id_list), URL_QUERY_CHUNK_SIZE):
+        query = session.query(WebPage.id, WebPage.last_crawled_text).filter(
+            WebPage.id.in_(page_id_list[i:i + URL_QUERY_CHUNK_SIZE]))
+        validators.update(query)
+    artifact_ids = [page_id for page_id in page_ids
+                    if (page_id, validators.get(page_id))
+                    not in _missing_processed_texts]
+    output = {}
+    for page_id, data in _fetcher('page_text_processed').iter_raw_page_texts(
+            artifact_ids):
+        tokens = decode_processed_text(data) if data is not None else None
+        if tokens is not None:
+            output[page_id] = tokens
+        elif page_id in validators:
+            _remember_missing_processed_text((page_id, validators[page_id]))
+    # pages without a current artifact are processed from the raw text
+    page_texts = get_page_text_dict(page_ids - set(output), silent=silent)
+    missing_ids = page_texts.keys()
+    processed_texts = process_texts(page_texts[page_id] for page_id in missing_ids)
+    output.update(zip(missing_ids, processed_texts))
     return output
@@ -0,0 +1,221 @@
+"""Benchmarks for the keyword matching hot path.
+
+Generates a synthetic corpus with a Zipfian vocabulary, runs process_text,
+PageKeywordMatcher.matching_keywords (plain and compiled) and
+PageEntityMatcher.matching_entities over it and prints the results as JSON.
+Every case runs in its own child process, so its peak RSS is its own.
+
+    python -m affine.detection.nlp.keywords.benchmark -output results.json
+"""
+import argparse
+import bisect
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import string
+import sys
+import time
+from logging import getLogger
+
+from .keyword_matching import process_text, PageKeywordMatcher, \
+    PageEntityMatcher
+
+logger = getLogger(__name__)
+
+__all__ = ['SyntheticCorpus', 'run_benchmarks']
+
+PAGE_LENGTHS = [100, 1000, 10000, 100000, 500000]
+KEYWORD_COUNTS = [10, 100, 1000, 10000, 100000]
+QUICK_PAGE_LENGTHS = [100, 1000, 10000]
+QUICK_KEYWORD_COUNTS = [10, 1000]
+VOCAB_SIZE = 50000
+ZIPF_EXPONENT = 1.1
+MAX_PHRASE_LEN = 4
+PERCENTILES = [50, 90, 99]
+
+
+class SyntheticCorpus(object):
+    """Random words, pages and keyword phrases with Zipfian word frequencies"""
+
+    def __init__(self, vocab_size=VOCAB_SIZE, exponent=ZIPF_EXPONENT, seed=0):
+        self.random = random.Random(seed)
+        words = set()
+        while len(words) < vocab_size:
+            length = self.random.randint(3, 10)
+            words.add(''.join(self.random.choice(string.ascii_lowercase)
+                              for _ in xrange(length)))
+        self.vocab = sorted(words)
+        self.random.shuffle(self.vocab)
+        self.cumulative_weights = []
+        total = 0.0
+        for rank in xrange(1, vocab_size + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative_weights.append(total)
+
+    def word(self):
+        point = self.random.random() * self.cumulative_weights[-1]
+        return self.vocab[bisect.bisect(self.cumulative_weights, point)]
+
+    def page(self, num_tokens):
+        return ' '.join(self.word() for _ in xrange(num_tokens))
+
+    def phrases(self, count, max_len=MAX_PHRASE_LEN):
+        """count distinct phrases of 1 to max_len words"""
+        phrases = set()
+        while len(phrases) < count:
+            length = self.random.randint(1, max_len)
+            phrases.add(' '.join(self.word() for _ in xrange(length)))
+        return sorted(phrases)
+
+
+def peak_rss_kb():
+    """High-water mark of the resident set size of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+def _percentile(sorted_values, pct):
+    index = int(round((pct / 100.0) * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _time_calls(func, args_list, num_tokens):
+    """Runs func on every args tuple and summarizes the timings"""
+    latencies = []
+    for args in args_list:
+        start = time.time()
+        func(*args)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    total = sum(latencies)
+    result = {
+        'calls': len(latencies),
+        'tokens_per_call': num_tokens,
+        'tokens_per_sec': (num_tokens * len(latencies) / total) if total else None,
+    }
+    for pct in PERCENTILES:
+        result['latency_p%d_ms' % pct] = 1000 * _percentile(latencies, pct)
+    return result
+
+
+def _pages(corpus, num_tokens, count, seed):
+    # every case regenerates its pages, so seed them by length
+    corpus.random.seed('%s:pages:%d' % (seed, num_tokens))
+    return [corpus.page(num_tokens) for _ in xrange(count)]
+
+
+def _phrases(corpus, num_keywords, seed):
+    corpus.random.seed('%s:phrases:%d' % (seed, num_keywords))
+    return corpus.phrases(num_keywords)
+
+
+def _run_case(name, num_tokens, num_keywords, pages_per_length, seed):
+    """Builds the inputs of one benchmark case and times it"""
+    corpus = SyntheticCorpus(seed=seed)
+    texts = _pages(corpus, num_tokens, pages_per_length, seed)
+    if name == 'process_text':
+        func, args_list = process_text, [(text,) for text in texts]
+        extra = {}
+    elif name == 'matching_entities':
+        ne_matcher = PageEntityMatcher()
+        start = time.time()
+        for ne_id, phrase in enumerate(_phrases(corpus, num_keywords, seed)):
+            ne_matcher.add_entity(ne_id, phrase)
+        extra = {'build_sec': time.time() - start}
+        # entities are matched against unstemmed tokens, as in production
+        func = ne_matcher.matching_entities
+        args_list = [(process_text(text, stemming=False),) for text in texts]
+    else:
+        kw_matcher = PageKeywordMatcher()
+        start = time.time()
+        for kw_id, phrase in enumerate(_phrases(corpus, num_keywords, seed)):
+            kw_matcher.add_keyword(kw_id, phrase)
+        extra = {'build_sec': time.time() - start}
+        func = kw_matcher.matching_keywords
+        if name == 'compiled_matching_keywords':
+            start = time.time()
+            func = kw_matcher.compile().matching_keywords
+            extra['compile_sec'] = time.time() - start
+        args_list = [(process_text(text),) for text in texts]
+    del corpus, texts
+    logger.info('Benchmarking %s, %s keywords, %d tokens',
+                name, num_keywords, num_tokens)
+    rss_before = peak_rss_kb()
+    result = _time_calls(func, args_list, num_tokens)
+    result.update(extra)
+    result.update(benchmark=name, page_tokens=num_tokens,
+                  peak_rss_kb=peak_rss_kb(),
+                  match_rss_delta_kb=peak_rss_kb() - rss_before)
+    if num_keywords is not None:
+        result['keywords'] = num_keywords
+    return result
+
+
+def _run_case_args(args):
+    return _run_case(*args)
+
+
+def run_benchmarks(page_lengths=PAGE_LENGTHS, keyword_counts=KEYWORD_COUNTS,
+                   pages_per_length=5, seed=0):
+    """Runs every case in a fresh child process.
+
+    ru_maxrss is a per-process high-water mark, so peak_rss_kb is only
+    meaningful for a process that ran a single case. It still includes the
+    interpreter and the case inputs; match_rss_delta_kb is the growth while
+    the timed calls ran.
+    """
+    cases = [('process_text', num_tokens, None, pages_per_length, seed)
+             for num_tokens in page_lengths]
+    for num_keywords in keyword_counts:
+        for num_tokens in page_lengths:
+            for name in ['matching_keywords', 'compiled_matching_keywords',
+                         'matching_entities']:
+                cases.append((name, num_tokens, num_keywords,
+                              pages_per_length, seed))
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = [pool.apply(_run_case_args, (case,)) for case in cases]
+    finally:
+        pool.close()
+        pool.join()
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-output', dest='output', required=False,
+                        help='JSON file to write, stdout if not given')
+    parser.add_argument('-pages-per-length', dest='pages_per_length',
+                        type=int, default=5,
+                        help='Number of pages timed for every page length')
+    parser.add_argument('-seed', dest='seed', type=int, default=0,
+                        help='Random seed for the synthetic corpus')
+    parser.add_argument('-quick', dest='quick', action='store_true',
+                        help='Only run the smaller page and keyword sizes')
+    args = parser.parse_args()
+    if args.quick:
+        page_lengths, keyword_counts = QUICK_PAGE_LENGTHS, QUICK_KEYWORD_COUNTS
+    else:
+        page_lengths, keyword_counts = PAGE_LENGTHS, KEYWORD_COUNTS
+    report = run_benchmarks(page_lengths, keyword_counts,
+                            pages_per_length=args.pages_per_length,
+                            seed=args.seed)
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fo:
+            fo.write(report_json + '\n')
+    else:
+        print report_json
+
+if __name__ == '__main__':
+    main()
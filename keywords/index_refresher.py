@@ -0,0 +1,125 @@
+"""Keeps a live label keyword scorer in sync with the DB.
+
+Workers build the scorer once and then call maybe_sync between pages.
+Each sync patches the scorer with the weighted keywords added or removed
+since the last sync, so a dashboard edit reaches the workers without a full
+rebuild. keyword_index_refresher is the refresher WebPage.keyword_results
+uses when there is no current compiled keyword index.
+"""
+import threading
+import time
+from logging import getLogger
+
+from affine.model import session, Keyword, WeightedKeyword, LabelHash
+from affine.model._sqla_imports import func
+from .keyword_scoring import LabelKeywordScorer
+
+__all__ = ['KeywordIndexRefresher', 'keyword_index_refresher']
+
+logger = getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 10  # seconds
+
+
+def weighted_keywords_stamp():
+    """Changes whenever weighted keywords are added or removed, or a label
+    hash is updated after its keyword weights changed.
+
+    Only counts and maxima over primary keys and one timestamp, as
+    current_index_version does, so polling it does not read the tables.
+    """
+    wk_stamp = session.query(func.count(), func.max(WeightedKeyword.label_id),
+                             func.max(WeightedKeyword.keyword_id)).one()
+    hash_stamp = session.query(func.count(LabelHash.label_id),
+                               func.max(LabelHash.hash_updated_at)).one()
+    return tuple(wk_stamp) + tuple(hash_stamp)
+
+
+class KeywordIndexRefresher(object):
+    """Live label keyword scorer.
+
+    None of the keyword tables have an updated_at column, so when the stamp
+    changes the weighted keywords are read and diffed against the rows of
+    the last sync. Syncs and matches hold the lock, so a match never sees a
+    half applied diff.
+    """
+
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.last_sync = None
+        self.label_scorer = LabelKeywordScorer()
+        self.lock = threading.Lock()
+        # keeps two threads from applying the same diff
+        self._sync_lock = threading.Lock()
+        self._stamp = None
+        self._rows = set()
+
+    def _read_rows(self):
+        query = session.query(WeightedKeyword.label_id, Keyword.text,
+                              WeightedKeyword.title_weight,
+                              WeightedKeyword.body_weight)
+        return set(query.join(WeightedKeyword.keyword))
+
+    def sync(self):
+        """Patches the scorer with all changes since the last sync.
+
+        Returns the number of rows that were added or removed.
+        """
+        with self._sync_lock:
+            return self._sync()
+
+    def _sync(self):
+        stamp = weighted_keywords_stamp()
+        self.last_sync = time.time()
+        if stamp == self._stamp:
+            return 0
+        rows = self._read_rows()
+        removed, added = self._rows - rows, rows - self._rows
+        with self.lock:
+            for label_id, kw_text, title_weight, body_weight in removed:
+                self.label_scorer.remove_keyword(
+                    label_id, kw_text, title_weight, body_weight)
+            for label_id, kw_text, title_weight, body_weight in added:
+                self.label_scorer.add_keyword(
+                    label_id, kw_text, title_weight, body_weight)
+            self.label_scorer.commit()
+        self._rows, self._stamp = rows, stamp
+        num_changes = len(removed) + len(added)
+        if num_changes:
+            logger.info('Applied %d keyword index changes', num_changes)
+        return num_changes
+
+    def maybe_sync(self):
+        """Syncs if the poll interval has passed since the last sync"""
+        if self.last_sync is None or \
+                time.time() - self.last_sync >= self.poll_interval:
+            return self.sync()
+        return 0
+
+    def score_tokens(self, title, body, label_ids=None):
+        """LabelKeywordScorer.score_tokens for the labels in label_ids (all
+        labels if None), after syncing if the poll interval has passed"""
+        self.maybe_sync()
+        with self.lock:
+            hits = self.label_scorer.score_tokens(title, body)
+        if label_ids is not None:
+            label_ids = set(label_ids)
+            hits = {label_id: label_hits
+                    for label_id, label_hits in hits.iteritems()
+                    if label_id in label_ids}
+        return hits
+
+    def score_page(self, page, label_ids=None):
+        return self.score_tokens(page.processed_title,
+                                 page.processed_description_text, label_ids)
+
+
+_refresher = None
+
+
+def keyword_index_refresher():
+    """Process-wide refresher, loaded on first use"""
+    global _refresher
+    if _refresher is None:
+        _refresher = KeywordIndexRefresher()
+    return _refresher
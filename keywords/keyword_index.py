@@ -0,0 +1,402 @@
+"""Compiled keyword index shared by all workers on a box.
+
+The index holds every label keyword and user keyword in a single
+Aho-Corasick automaton and is written to one versioned binary file.
+Workers open the file with mmap, so the arrays are never copied into
+process memory and all processes on a box share the same page cache.
+
+File layout (all integers little-endian):
+    8 bytes   magic
+    8 bytes   header length (uint64)
+    header    JSON dict with the version stamp and the (offset, dtype,
+              length) of every section, relative to the start of the file
+    sections  numpy arrays, each 8 byte aligned
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from logging import getLogger
+
+import numpy as np
+
+from affine import config
+from affine.model import session, Keyword, WeightedKeyword, UserKeyword, \
+    LabelHash
+from affine.model._sqla_imports import func
+from .keyword_matching import PageKeywordMatcher
+from .normalization import iter_process_text
+
+__all__ = ['KeywordIndex', 'build_keyword_index', 'load_keyword_index',
+           'get_keyword_index', 'current_keyword_index',
+           'current_index_version', 'default_index_path']
+
+logger = getLogger(__name__)
+
+MAGIC = 'AKWIDX01'
+ALIGNMENT = 8
+EMPTY = -1
+# Mixing constant for the open addressing tables (Knuth)
+HASH_MULTIPLIER = 2654435761
+TOKEN_CACHE_SIZE = 100000
+# Seconds between checks that an index still matches the keywords in the DB
+INDEX_CHECK_INTERVAL = 60
+
+
+def default_index_path():
+    path = config.get('affine.keyword_index.path')
+    if path is None:
+        path = os.path.join(config.scratch_detector_path(), 'keyword_index.bin')
+    return path
+
+
+def current_index_version():
+    """Version stamp for the keywords currently in the DB.
+
+    Derived from the LabelHash tags (which cover every label's weighted
+    keywords) and the user keyword table.
+    """
+    digest = hashlib.sha1()
+    query = session.query(LabelHash.label_id, LabelHash.hash_tag)
+    for label_id, hash_tag in query.order_by(LabelHash.label_id):
+        digest.update('%s:%s;' % (label_id, hash_tag))
+    query = session.query(func.count(UserKeyword.id), func.max(UserKeyword.id),
+                          func.max(UserKeyword.timestamp))
+    digest.update('%s:%s:%s' % query.one())
+    return digest.hexdigest()
+
+
+def _table_size(num_items):
+    size = 8
+    while size < 2 * num_items:
+        size *= 2
+    return size
+
+
+def _slot(key, size):
+    return (key * HASH_MULTIPLIER) & (size - 1)
+
+
+def _token_hash(encoded_token):
+    return zlib.crc32(encoded_token) & 0xffffffff
+
+
+def _serialize_matcher(matcher):
+    """Turns a CompiledKeywordMatcher into the flat arrays of the index"""
+    tokens = [None] * len(matcher.vocab)
+    for token, token_id in matcher.vocab.iteritems():
+        tokens[token_id] = token.encode('utf-8')
+    token_offsets = np.zeros(len(tokens) + 1, dtype='<i8')
+    token_offsets[1:] = np.cumsum([len(token) for token in tokens])
+    token_blob = np.frombuffer(''.join(tokens) or '\0', dtype='u1')
+
+    token_table = np.full(_table_size(len(tokens)), EMPTY, dtype='<i4')
+    for token_id, token in enumerate(tokens):
+        slot = _slot(_token_hash(token), len(token_table))
+        while token_table[slot] != EMPTY:
+            slot = (slot + 1) & (len(token_table) - 1)
+        token_table[slot] = token_id
+
+    num_tokens = max(len(tokens), 1)
+    num_edges = sum(len(edges) for edges in matcher.goto)
+    edge_keys = np.full(_table_size(num_edges), EMPTY, dtype='<i8')
+    edge_next = np.zeros(len(edge_keys), dtype='<i4')
+    for state, edges in enumerate(matcher.goto):
+        for token_id, next_state in edges.iteritems():
+            key = state * num_tokens + token_id
+            slot = _slot(key, len(edge_keys))
+            while edge_keys[slot] != EMPTY:
+                slot = (slot + 1) & (len(edge_keys) - 1)
+            edge_keys[slot] = key
+            edge_next[slot] = next_state
+
+    label_rows, user_rows = [], []
+    label_start = np.zeros(len(matcher.goto) + 1, dtype='<i4')
+    user_start = np.zeros(len(matcher.goto) + 1, dtype='<i4')
+    for state, kw_ids in enumerate(matcher.outputs):
+        for kw_id in sorted(kw_ids):
+            if kw_id[0] == 'label':
+                label_rows.append(kw_id[1:])
+            else:
+                user_rows.append(kw_id[1:])
+        label_start[state + 1] = len(label_rows)
+        user_start[state + 1] = len(user_rows)
+
+    return {
+        'token_offsets': token_offsets,
+        'token_blob': token_blob,
+        'token_table': token_table,
+        'edge_keys': edge_keys,
+        'edge_next': edge_next,
+        'fail': np.array(matcher.fail, dtype='<i4'),
+        'output_link': np.array(matcher.output_link, dtype='<i4'),
+        'label_start': label_start,
+        # (keyword_id, label_id, body_weight, title_weight)
+        'label_payload': np.array(label_rows or [(0, 0, 0, 0)], dtype='<i4'),
+        'user_start': user_start,
+        # (user_keyword_id, title_only)
+        'user_payload': np.array(user_rows or [(0, 0)], dtype='<i4'),
+    }
+
+
+def _write_index(path, version, arrays):
+    sections = {}
+    offset = 0
+    for name in sorted(arrays):
+        array = arrays[name]
+        sections[name] = [offset, array.dtype.str, list(array.shape)]
+        offset += array.nbytes
+        offset += -offset % ALIGNMENT
+    header = json.dumps({'version': version, 'sections': sections,
+                         'num_tokens': len(arrays['token_offsets']) - 1})
+    header += ' ' * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+    data_start = len(MAGIC) + 8 + len(header)
+
+    # Write to a temp file and rename, so that workers that have the old
+    # file mapped keep reading a consistent copy
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            fo.write(MAGIC)
+            fo.write(struct.pack('<Q', len(header)))
+            fo.write(header)
+            for name in sorted(arrays):
+                assert fo.tell() == data_start + sections[name][0]
+                fo.write(arrays[name].tostring())
+                fo.write('\0' * (-fo.tell() % ALIGNMENT))
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def build_keyword_index(path=None):
+    """Compiles all label keywords and user keywords into an index file.
+
+    Returns the version stamp of the written index.
+    """
+    path = path or default_index_path()
+    version = current_index_version()
+    matcher = PageKeywordMatcher()
+    query = session.query(Keyword.id, Keyword.text, WeightedKeyword.label_id,
+                          WeightedKeyword.body_weight,
+                          WeightedKeyword.title_weight)
+    query = query.join(WeightedKeyword)
+    for kw_id, kw_text, label_id, body_weight, title_weight in query:
+        matcher.add_keyword(
+            ('label', kw_id, label_id, body_weight, title_weight), kw_text)
+    query = session.query(UserKeyword.id, UserKeyword.text,
+                          UserKeyword.title_only)
+    for uk_id, uk_text, title_only in query:
+        matcher.add_keyword(('user', uk_id, int(title_only)), uk_text)
+    arrays = _serialize_matcher(matcher.compile())
+    _write_index(path, version, arrays)
+    logger.info('Wrote keyword index %s (version %s)', path, version)
+    return version
+
+
+def load_keyword_index(path=None):
+    return KeywordIndex(path or default_index_path())
+
+
+_loaded_indexes = {}
+
+
+def get_keyword_index(path=None):
+    """Process-wide index for path, remapped when the build step rewrites it"""
+    path = path or default_index_path()
+    index = _loaded_indexes.get(path)
+    if index is None or index.file_changed():
+        index = _loaded_indexes[path] = load_keyword_index(path)
+    return index
+
+
+# path -> (index, time of the last version check, whether it was stale)
+_index_checks = {}
+
+
+def current_keyword_index(path=None):
+    """get_keyword_index(path), or None if there is no index file or it was
+    built from other keywords than the ones in the DB.
+
+    The version is checked at most every affine.keyword_index.check_interval
+    seconds, so edits reach the index users once the build step has run.
+    """
+    path = path or default_index_path()
+    if not os.path.exists(path):
+        return None
+    index = get_keyword_index(path)
+    now = time.time()
+    check = _index_checks.get(path)
+    interval = config.get('affine.keyword_index.check_interval',
+                          INDEX_CHECK_INTERVAL)
+    if check is None or check[0] is not index or now - check[1] >= interval:
+        stale = index.is_stale()
+        if stale:
+            logger.info('Keyword index %s is stale', path)
+        check = _index_checks[path] = (index, now, stale)
+    return None if check[2] else index
+
+
+class KeywordIndex(object):
+    """Read-only, memory-mapped view of a compiled keyword index"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fi:
+            self._inode = os.fstat(fi.fileno()).st_ino
+            self._mmap = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._mmap[:len(MAGIC)] == MAGIC, 'Not a keyword index: %s' % path
+        header_len, = struct.unpack('<Q', self._mmap[len(MAGIC):len(MAGIC) + 8])
+        data_start = len(MAGIC) + 8 + header_len
+        header = json.loads(self._mmap[len(MAGIC) + 8:data_start])
+        self.version = header['version']
+        self.num_tokens = header['num_tokens']
+        for name, (offset, dtype, shape) in header['sections'].iteritems():
+            count = int(np.prod(shape))
+            array = np.frombuffer(self._mmap, dtype=dtype, count=count,
+                                  offset=data_start + offset)
+            setattr(self, name, array.reshape(shape))
+        self._token_cache = {}
+
+    def close(self):
+        self._mmap.close()
+
+    def is_stale(self):
+        """True if the keywords in the DB changed since the index was built"""
+        return self.version != current_index_version()
+
+    def file_changed(self):
+        """True if a new index file was written since this one was mapped"""
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return False
+
+    def token_id(self, token):
+        try:
+            return self._token_cache[token]
+        except KeyError:
+            pass
+        encoded = token.encode('utf-8')
+        table, offsets, blob = self.token_table, self.token_offsets, self.token_blob
+        size = len(table)
+        slot = _slot(_token_hash(encoded), size)
+        token_id = None
+        while table[slot] != EMPTY:
+            candidate = int(table[slot])
+            start, end = offsets[candidate], offsets[candidate + 1]
+            if blob[start:end].tostring() == encoded:
+                token_id = candidate
+                break
+            slot = (slot + 1) & (size - 1)
+        if len(self._token_cache) >= TOKEN_CACHE_SIZE:
+            self._token_cache.clear()
+        self._token_cache[token] = token_id
+        return token_id
+
+    def _next_state(self, state, token_id):
+        key = state * max(self.num_tokens, 1) + token_id
+        keys = self.edge_keys
+        size = len(keys)
+        slot = _slot(key, size)
+        while keys[slot] != EMPTY:
+            if keys[slot] == key:
+                return int(self.edge_next[slot])
+            slot = (slot + 1) & (size - 1)
+        return None
+
+    def matching_states(self, text):
+        """Returns the set of automaton states whose keywords occur in text"""
+        if isinstance(text, basestring):
+            text = iter_process_text(text)
+        fail, output_link = self.fail, self.output_link
+        label_start, user_start = self.label_start, self.user_start
+        states = set()
+        state = 0
+        for token in text or []:
+            token_id = self.token_id(token)
+            if token_id is None:
+                state = 0
+                continue
+            next_state = self._next_state(state, token_id)
+            while next_state is None and state:
+                state = int(fail[state])
+                next_state = self._next_state(state, token_id)
+            state = next_state or 0
+            match_state = state
+            while match_state:
+                if (label_start[match_state] != label_start[match_state + 1] or
+                        user_start[match_state] != user_start[match_state + 1]):
+                    states.add(match_state)
+                match_state = int(output_link[match_state])
+        return states
+
+    def label_keywords(self, states):
+        """(keyword_id, label_id, body_weight, title_weight) rows for states"""
+        rows = set()
+        for state in states:
+            for row in self.label_payload[self.label_start[state]:
+                                          self.label_start[state + 1]]:
+                rows.add(tuple(int(i) for i in row))
+        return rows
+
+    def user_keyword_ids(self, states, title=True):
+        """User keyword ids for states, title_only keywords only in titles"""
+        uk_ids = set()
+        for state in states:
+            for uk_id, title_only in self.user_payload[
+                    self.user_start[state]:self.user_start[state + 1]]:
+                if title or not title_only:
+                    uk_ids.add(int(uk_id))
+        return uk_ids
+
+    def score_tokens(self, title, body, label_ids=None):
+        """Same as LabelKeywordScorer.score_tokens for the labels in
+        label_ids (all labels if None)"""
+        if label_ids is not None:
+            label_ids = set(label_ids)
+        matches = defaultdict(dict)
+        for kw_id, label_id, _, title_weight in \
+                self.label_keywords(self.matching_states(title)):
+            if label_ids is None or label_id in label_ids:
+                matches[label_id][kw_id] = title_weight
+        for kw_id, label_id, body_weight, _ in \
+                self.label_keywords(self.matching_states(body)):
+            if label_ids is None or label_id in label_ids:
+                label_matches = matches[label_id]
+                if not label_matches.get(kw_id):
+                    label_matches[kw_id] = body_weight
+        kw_ids = {kw_id for label_matches in matches.itervalues()
+                  for kw_id in label_matches}
+        texts = {}
+        if kw_ids:
+            query = session.query(Keyword.id, Keyword.text)
+            texts = dict(query.filter(Keyword.id.in_(kw_ids)))
+        return {label_id: [(texts[kw_id], weight)
+                           for kw_id, weight in label_matches.iteritems()
+                           if kw_id in texts]
+                for label_id, label_matches in matches.iteritems()}
+
+    def score_page(self, page, label_ids=None):
+        return self.score_tokens(page.processed_title,
+                                 page.processed_description_text, label_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-index-path', dest='index_path', required=False,
+                        help='Path of the keyword index file to write')
+    args = parser.parse_args()
+    build_keyword_index(args.index_path)
+
+if __name__ == '__main__':
+    main()
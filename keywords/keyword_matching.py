@@ -1,30 +1,13 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 from unidecode import unidecode
-import re
 
-import nltk
-from Stemmer import Stemmer
+from .normalization import tokenize as _tokenize, process_text, \
+    process_texts, iter_process_text, RecentlyUsedCache
 
-__all__ = ['process_text', 'PageKeywordMatcher', 'PageEntityMatcher']
+__all__ = ['process_text', 'process_texts', 'PageKeywordMatcher',
+           'CompiledKeywordMatcher', 'PageEntityMatcher']
 
-clean_re = re.compile(r"[\W_]", re.UNICODE)
-word_tokenizer = nltk.tokenize.treebank.TreebankWordTokenizer()
-
-
-def _tokenize(text):
-    if isinstance(text, str):
-        text = text.decode('utf-8')
-    words = word_tokenizer.tokenize(text.lower())
-    words = [clean_re.sub("", word) for word in words]
-    return filter(None, words)
-
-
-def process_text(text, stemming=True):
-    words = _tokenize(text)
-    if not stemming:
-        return words
-    stemmer = Stemmer('english')
-    return [stemmer.stemWord(word) for word in words]
+UNIDECODE_CACHE_SIZE = 200000
 
 
 class PageKeywordMatcher(object):
@@ -34,7 +17,7 @@ class PageKeywordMatcher(object):
 
     def _process(self, text):
         if isinstance(text, basestring):
-            text = process_text(text)
+            return iter_process_text(text)
         return text or []
 
     def add_keyword(self, kw_id, kw_text):
@@ -43,44 +26,267 @@ class PageKeywordMatcher(object):
             self.keywords[kw_text].append(kw_id)
         self.longest_keyword = max(len(kw_text), self.longest_keyword)
 
+    def remove_keyword(self, kw_id, kw_text):
+        kw_text = tuple(self._process(kw_text))
+        kw_ids = [i for i in self.keywords.get(kw_text, ()) if i != kw_id]
+        if kw_ids:
+            self.keywords[kw_text] = kw_ids
+        elif kw_text in self.keywords:
+            del self.keywords[kw_text]
+            if len(kw_text) == self.longest_keyword:
+                self.longest_keyword = max(
+                    [len(text) for text in self.keywords] or [0])
+
+    def matching_keywords(self, text):
+        """Ids of all keywords in text, which may be a string or any iterable
+        of processed tokens. Only the last longest_keyword tokens are kept.
+        """
+        matches = set()
+        if not self.longest_keyword:
+            return matches
+        window = deque(maxlen=self.longest_keyword)
+        for token in self._process(text):
+            window.append(token)
+            kw_text = tuple(window)
+            # every keyword that ends at this token
+            for start in xrange(len(kw_text)):
+                matches.update(self.keywords.get(kw_text[start:], ()))
+        return matches
+
+    def compile(self):
+        """Returns a CompiledKeywordMatcher for the keywords added so far"""
+        return CompiledKeywordMatcher(self.keywords)
+
+
+class CompiledKeywordMatcher(object):
+    """Aho-Corasick automaton over integer token ids.
+
+    Matches all keywords of a PageKeywordMatcher in a single pass over the
+    page tokens and returns the same keyword-id sets. Tokens that are not
+    part of any keyword reset the automaton to the root state. The automaton
+    is never modified while matching.
+
+    Keywords can be added and removed in place; call commit afterwards to
+    rebuild the failure links once for the whole change set. Matching never
+    rebuilds them, so matches can run while no change is being applied.
+    """
+
+    def __init__(self, keywords):
+        self.vocab = {}
+        # Per state: transitions (token_id -> state), failure link, ids of
+        # the keywords ending in the state and the closest failure-chain
+        # state that has keyword ids (0 if there is none).
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [()]
+        self.output_link = [0]
+        self.longest_keyword = 0
+        for kw_text, kw_ids in keywords.iteritems():
+            if kw_text and kw_ids:
+                self._insert(kw_text, kw_ids)
+        self._build_links()
+
+    def add_keyword(self, kw_id, kw_text):
+        kw_text = tuple(self._process(kw_text))
+        if kw_text:
+            self._insert(kw_text, (kw_id,))
+            self._links_stale = True
+
+    def remove_keyword(self, kw_id, kw_text):
+        state = self._find_state(tuple(self._process(kw_text)))
+        if state:
+            kw_ids = self.outputs[state]
+            self.outputs[state] = tuple(i for i in kw_ids if i != kw_id)
+            # output links may point at a state that no longer has ids
+            self._links_stale = self._links_stale or not self.outputs[state]
+
+    def commit(self):
+        """Rebuilds the failure links after keywords were added or removed"""
+        if self._links_stale:
+            self._build_links()
+
+    def _find_state(self, kw_text):
+        state = 0
+        for token in kw_text:
+            token_id = self.vocab.get(token)
+            if token_id is None:
+                return None
+            state = self.goto[state].get(token_id)
+            if state is None:
+                return None
+        return state
+
+    def _process(self, text):
+        if isinstance(text, basestring):
+            return iter_process_text(text)
+        return text or []
+
+    def _insert(self, kw_text, kw_ids):
+        state = 0
+        for token in kw_text:
+            token_id = self.vocab.setdefault(token, len(self.vocab))
+            next_state = self.goto[state].get(token_id)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][token_id] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append(())
+                self.output_link.append(0)
+            state = next_state
+        self.outputs[state] += tuple(kw_ids)
+        self.longest_keyword = max(len(kw_text), self.longest_keyword)
+
+    def _build_links(self):
+        self._links_stale = False
+        queue = deque(self.goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for token_id, next_state in self.goto[state].iteritems():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and token_id not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(token_id, 0)
+                self.fail[next_state] = fail
+                if self.outputs[fail]:
+                    self.output_link[next_state] = fail
+                else:
+                    self.output_link[next_state] = self.output_link[fail]
+
+    def token_ids(self, text):
+        """Maps page tokens to keyword token ids, None for unknown tokens"""
+        vocab = self.vocab
+        return (vocab.get(token) for token in self._process(text))
+
     def matching_keywords(self, text):
-        text = self._process(text)
+        assert not self._links_stale, 'Keywords changed since the last commit'
+        goto, fail = self.goto, self.fail
+        outputs, output_link = self.outputs, self.output_link
         matches = set()
-        for start in xrange(len(text)):
-            for kw_len in xrange(1, self.longest_keyword + 1):
-                kw_text = tuple(text[start: start + kw_len])
-                matches.update(self.keywords[kw_text])
+        state = 0
+        for token_id in self.token_ids(text):
+            if token_id is None:
+                state = 0
+                continue
+            while state and token_id not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token_id, 0)
+            match_state = state if outputs[state] else output_link[state]
+            while match_state:
+                matches.update(outputs[match_state])
+                match_state = output_link[match_state]
         return matches
 
 
 class PageEntityMatcher(object):
+    """Finds named entities in page text.
+
+    At every start position the longest entity starting there is matched,
+    unless it ends inside the envelope of the previous match. Entities are
+    kept in a token trie, so each start position costs one walk down the
+    trie instead of one dict probe per candidate length.
+    """
+    # Trie nodes are dicts keyed by token; this key holds the entity id
+    _ENTITY_ID = None
+
     def __init__(self):
+        # token tuple -> ids of the entities normalized to it, the one that
+        # is matched last
         self.entities = {}
+        self.trie = {}
         self.longest_entity = 0
 
     def _process(self, text):
         if isinstance(text, basestring):
-            text = process_text(text, stemming=False)
-        text = [unidecode(w) for w in text]
-        return text or []
+            text = iter_process_text(text, stemming=False)
+        return (_cached_unidecode(w) for w in text or [])
 
     def add_entity(self, ne_id, ne_text):
         ne_text = tuple(self._process(ne_text))
         if ne_text:
-            self.entities[ne_text] = ne_id
+            ne_ids = self.entities.setdefault(ne_text, [])
+            if ne_id in ne_ids:
+                ne_ids.remove(ne_id)
+            ne_ids.append(ne_id)
+            node = self.trie
+            for token in ne_text:
+                node = node.setdefault(token, {})
+            node[self._ENTITY_ID] = ne_id
         self.longest_entity = max(len(ne_text), self.longest_entity)
 
+    def remove_entity(self, ne_id, ne_text):
+        """Removes the entity. Another entity normalized to the same tokens
+        is matched in its place, if there is one."""
+        ne_text = tuple(self._process(ne_text))
+        ne_ids = self.entities.get(ne_text)
+        if not ne_ids or ne_id not in ne_ids:
+            return
+        ne_ids.remove(ne_id)
+        path = [self.trie]
+        for token in ne_text:
+            path.append(path[-1][token])
+        if ne_ids:
+            path[-1][self._ENTITY_ID] = ne_ids[-1]
+            return
+        del self.entities[ne_text]
+        del path[-1][self._ENTITY_ID]
+        # prune the nodes that no longer lead to an entity
+        for depth in xrange(len(ne_text), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][ne_text[depth - 1]]
+        if len(ne_text) == self.longest_entity:
+            self.longest_entity = max(
+                [len(text) for text in self.entities] or [0])
+
+    def _longest_match(self, window):
+        """(entity id, length) of the longest entity at the window start"""
+        node = self.trie
+        ne_id, ne_len = None, 0
+        for length, token in enumerate(window, 1):
+            node = node.get(token)
+            if node is None:
+                break
+            if node.get(self._ENTITY_ID) is not None:
+                ne_id, ne_len = node[self._ENTITY_ID], length
+        return ne_id, ne_len
+
     def matching_entities(self, text):
-        text = self._process(text)
+        """Entity ids in text, which may be a string or any iterable of
+        tokens. Only the next longest_entity tokens are kept in memory.
+        """
         matches = []
+        if not self.longest_entity:
+            return matches
         env = -1
-        for start in xrange(len(text)):
-            for ne_len in xrange(self.longest_entity, 0, -1):
-                if min(start + ne_len, len(text)) <= env:
+        start = 0
+        window = deque()
+        tokens = self._process(text)
+        while True:
+            for token in tokens:
+                window.append(token)
+                if len(window) == self.longest_entity:
                     break
-                ne_text = tuple(text[start: start + ne_len])
-                ne_id = self.entities.get(ne_text)
-                if ne_id is not None:
+            if not window:
+                break
+            if start + len(window) > env:
+                ne_id, ne_len = self._longest_match(window)
+                if ne_id is not None and start + ne_len > env:
                     matches.append(ne_id)
-                    env = min(start + ne_len, len(text))
+                    env = start + ne_len
+            window.popleft()
+            start += 1
         return matches
+
+
+_unidecode_cache = RecentlyUsedCache(UNIDECODE_CACHE_SIZE)
+
+
+def _cached_unidecode(word):
+    """unidecode with a process-wide cache shared across pages"""
+    decoded = _unidecode_cache.get(word)
+    if decoded is None:
+        decoded = unidecode(word)
+        _unidecode_cache.put(word, decoded)
+    return decoded
@@ -0,0 +1,96 @@
+from collections import defaultdict
+
+from affine.model import session, Keyword, WeightedKeyword
+from affine.model.web_pages import get_page_processed_text_dict
+from .keyword_matching import PageKeywordMatcher, process_text
+
+__all__ = ['LabelKeywordScorer']
+
+
+class LabelKeywordScorer(object):
+    """Scores pages against the weighted keywords of many labels at once.
+
+    All keywords go into one compiled matcher, so a page title and body are
+    each tokenized and scanned once no matter how many labels are scored.
+    """
+
+    def __init__(self):
+        self._matcher = PageKeywordMatcher()
+        self._compiled = None
+
+    @classmethod
+    def from_db(cls, label_ids=None):
+        """Scorer for the weighted keywords of label_ids (all labels if None)"""
+        scorer = cls()
+        query = session.query(WeightedKeyword.label_id, Keyword.text,
+                              WeightedKeyword.title_weight,
+                              WeightedKeyword.body_weight)
+        query = query.join(WeightedKeyword.keyword)
+        if label_ids is not None:
+            query = query.filter(WeightedKeyword.label_id.in_(label_ids))
+        for label_id, kw_text, title_weight, body_weight in query:
+            scorer.add_keyword(label_id, kw_text, title_weight, body_weight)
+        return scorer
+
+    def add_keyword(self, label_id, kw_text, title_weight, body_weight):
+        kw_id = (label_id, kw_text, title_weight, body_weight)
+        self._matcher.add_keyword(kw_id, kw_text)
+        if self._compiled is not None:
+            self._compiled.add_keyword(kw_id, kw_text)
+
+    def remove_keyword(self, label_id, kw_text, title_weight, body_weight):
+        kw_id = (label_id, kw_text, title_weight, body_weight)
+        self._matcher.remove_keyword(kw_id, kw_text)
+        if self._compiled is not None:
+            self._compiled.remove_keyword(kw_id, kw_text)
+
+    def commit(self):
+        """Applies the keywords added or removed since the last commit"""
+        if self._compiled is not None:
+            self._compiled.commit()
+
+    @property
+    def matcher(self):
+        if self._compiled is None:
+            self._compiled = self._matcher.compile()
+        return self._compiled
+
+    def score_tokens(self, title, body):
+        """Keyword hits for all labels given processed title and body tokens.
+
+        Returns a dict mapping label_id to a list of (kw_text, weight). As in
+        WebPage.keyword_results, the title weight of a keyword is used if it
+        is in the title, and the body weight only if the title weight is
+        missing or 0.
+        """
+        if isinstance(title, basestring):
+            title = process_text(title)
+        if isinstance(body, basestring):
+            body = process_text(body)
+        matches = defaultdict(dict)
+        for label_id, kw_text, title_weight, _ in \
+                self.matcher.matching_keywords(title):
+            matches[label_id][kw_text] = title_weight
+        for label_id, kw_text, _, body_weight in \
+                self.matcher.matching_keywords(body):
+            label_matches = matches[label_id]
+            if not label_matches.get(kw_text):
+                label_matches[kw_text] = body_weight
+        return {label_id: label_matches.items()
+                for label_id, label_matches in matches.iteritems()}
+
+    def score_page(self, page):
+        return self.score_tokens(page.processed_title,
+                                 page.processed_description_text)
+
+    def score_pages(self, pages):
+        """Scores a batch of pages, fetching their body text in bulk.
+
+        Returns a dict mapping page_id to the output of score_tokens.
+        """
+        pages = list(pages)
+        page_ids = [page.id for page in pages if page.s3_page_text]
+        bodies = get_page_processed_text_dict(page_ids, silent=True)
+        return {page.id: self.score_tokens(page.processed_title,
+                                           bodies.get(page.id))
+                for page in pages}
@@ -0,0 +1,159 @@
+"""Tokenization and stemming of page text for keyword matching.
+
+Stemmers are created once per thread and stems are kept in a bounded
+cache, since page vocabularies are dominated by a small set of words.
+"""
+import re
+import threading
+from multiprocessing import Pool
+
+import nltk
+from Stemmer import Stemmer
+
+__all__ = ['tokenize', 'stem_words', 'process_text', 'process_texts',
+           'iter_text_chunks', 'iter_tokens', 'iter_stems', 'iter_process_text',
+           'RecentlyUsedCache', 'PROCESSED_TEXT_VERSION']
+
+clean_re = re.compile(r"[\W_]", re.UNICODE)
+word_tokenizer = nltk.tokenize.treebank.TreebankWordTokenizer()
+
+# Version of the process_text output. Bump it whenever a change to the
+# tokenizer or stemmer changes the tokens, so that stored processed text is
+# recomputed instead of read back.
+PROCESSED_TEXT_VERSION = 1
+STEM_CACHE_SIZE = 200000
+# Page text is tokenized in chunks of about this many characters
+TEXT_CHUNK_SIZE = 64 * 1024
+# Below this many texts process_texts does not bother starting a pool
+MIN_TEXTS_FOR_POOL = 1000
+POOL_CHUNKSIZE = 100
+
+_thread_state = threading.local()
+
+
+class RecentlyUsedCache(object):
+    """Bounded cache that keeps the most recently used entries.
+
+    Entries live in two generations of at most maxsize / 2 entries. When the
+    current generation fills up it replaces the previous one, and a hit in
+    the previous generation moves the entry back to the current one. This
+    evicts in approximately LRU order without bookkeeping on every hit.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def get(self, key, default=None):
+        try:
+            return self._current[key]
+        except KeyError:
+            pass
+        try:
+            value = self._previous.pop(key)
+        except KeyError:
+            return default
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if len(self._current) >= max(self.maxsize // 2, 1):
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = value
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+
+def _stemmer_and_cache():
+    try:
+        return _thread_state.stemmer, _thread_state.stem_cache
+    except AttributeError:
+        _thread_state.stemmer = Stemmer('english')
+        _thread_state.stem_cache = RecentlyUsedCache(STEM_CACHE_SIZE)
+        return _thread_state.stemmer, _thread_state.stem_cache
+
+
+def iter_text_chunks(text, chunk_size=TEXT_CHUNK_SIZE):
+    """Splits text at spaces into chunks of at least chunk_size characters.
+
+    The treebank tokenizer pads its input with spaces, so tokenizing the
+    chunks one by one gives the same cleaned tokens as the whole text.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find(' ', start + chunk_size)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def iter_tokens(text):
+    """Generator version of tokenize that works on one chunk at a time"""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    for chunk in iter_text_chunks(text):
+        for word in word_tokenizer.tokenize(chunk.lower()):
+            word = clean_re.sub("", word)
+            if word:
+                yield word
+
+
+def iter_stems(words):
+    stemmer, cache = _stemmer_and_cache()
+    for word in words:
+        stem = cache.get(word)
+        if stem is None:
+            stem = stemmer.stemWord(word)
+            cache.put(word, stem)
+        yield stem
+
+
+def iter_process_text(text, stemming=True):
+    """Generator version of process_text with bounded memory use"""
+    words = iter_tokens(text)
+    if not stemming:
+        return words
+    return iter_stems(words)
+
+
+def tokenize(text):
+    return list(iter_tokens(text))
+
+
+def stem_words(words):
+    return list(iter_stems(words))
+
+
+def process_text(text, stemming=True):
+    return list(iter_process_text(text, stemming))
+
+
+def _process_text_args(args):
+    return process_text(*args)
+
+
+def process_texts(texts, stemming=True, processes=None):
+    """Runs process_text on every text and returns the results in order.
+
+    Large batches are split across a pool of `processes` worker processes.
+    """
+    texts = list(texts)
+    if not processes or processes < 2 or len(texts) < MIN_TEXTS_FOR_POOL:
+        return [process_text(text, stemming) for text in texts]
+    pool = Pool(processes)
+    try:
+        return pool.map(_process_text_args,
+                        [(text, stemming) for text in texts],
+                        chunksize=POOL_CHUNKSIZE)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,136 @@
+"""Keyword scanning of page titles straight from the DB.
+
+Title-only user keywords and the title weights of label keywords only need
+WebPage.processed_title, so these scans page through the web_pages table in
+id order and never download page text from S3.
+
+    python -m affine.detection.nlp.keywords.title_scanning -min-page-id 0
+"""
+import argparse
+import time
+from logging import getLogger
+
+from affine.model import session, WebPage, UserKeyword, \
+    WebPageUserKeywordResult
+from .keyword_matching import PageKeywordMatcher
+from .keyword_scoring import LabelKeywordScorer
+
+__all__ = ['iter_processed_titles', 'TitleKeywordScanner']
+
+logger = getLogger(__name__)
+
+TITLE_BATCH_SIZE = 10000
+
+
+def iter_processed_titles(min_page_id=0, max_page_id=None,
+                          batch_size=TITLE_BATCH_SIZE):
+    """Yields (page_id, processed title tokens) for pages in id order.
+
+    Pages are read in batches of batch_size rows, each starting after the
+    last id of the previous batch, so every query is a short range scan.
+    """
+    last_id = min_page_id - 1
+    while True:
+        query = session.query(WebPage.id, WebPage.processed_title)
+        query = query.filter(WebPage.id > last_id)
+        if max_page_id is not None:
+            query = query.filter(WebPage.id <= max_page_id)
+        rows = query.order_by(WebPage.id).limit(batch_size).all()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
+
+
+class TitleKeywordScanner(object):
+    """Matches title-only user keywords and label title weights"""
+
+    def __init__(self, label_scorer, user_keyword_matcher):
+        self.label_scorer = label_scorer
+        self.user_keyword_matcher = user_keyword_matcher
+
+    @classmethod
+    def from_db(cls, label_ids=None):
+        matcher = PageKeywordMatcher()
+        query = session.query(UserKeyword.id, UserKeyword.text)
+        for uk_id, uk_text in query.filter_by(title_only=True):
+            matcher.add_keyword(uk_id, uk_text)
+        return cls(LabelKeywordScorer.from_db(label_ids), matcher.compile())
+
+    @property
+    def user_keyword_ids(self):
+        """Ids of all title-only user keywords in the scanner"""
+        uk_ids = set()
+        for kw_ids in self.user_keyword_matcher.outputs:
+            uk_ids.update(kw_ids)
+        return uk_ids
+
+    def scan_title(self, title):
+        """(user keyword ids, label keyword hits) for processed title tokens.
+
+        Label hits are a dict mapping label_id to a list of (kw_text,
+        title_weight), as in LabelKeywordScorer.score_tokens.
+        """
+        uk_ids = self.user_keyword_matcher.matching_keywords(title)
+        return uk_ids, self.label_scorer.score_tokens(title, [])
+
+    def scan(self, min_page_id=0, max_page_id=None,
+             batch_size=TITLE_BATCH_SIZE):
+        """Yields (page_id, user keyword ids, label keyword hits) per page"""
+        for page_id, title in iter_processed_titles(min_page_id, max_page_id,
+                                                    batch_size):
+            uk_ids, label_hits = self.scan_title(title)
+            yield page_id, uk_ids, label_hits
+
+    def backfill_user_keyword_results(self, min_page_id=0, max_page_id=None,
+                                      batch_size=TITLE_BATCH_SIZE):
+        """Rewrites the title-only user keyword results of a page id range.
+
+        Results of keywords that are not title-only are left alone.
+        Returns (num_inserted, num_deleted).
+        """
+        uk_ids = self.user_keyword_ids
+        if not uk_ids:
+            return 0, 0
+        num_inserted = num_deleted = 0
+        page_results = {}
+        for page_id, title in iter_processed_titles(min_page_id, max_page_id,
+                                                    batch_size):
+            page_results[page_id] = \
+                self.user_keyword_matcher.matching_keywords(title)
+            if len(page_results) >= batch_size:
+                inserted, deleted = WebPageUserKeywordResult.reconcile_results(
+                    page_results, uk_ids)
+                num_inserted += inserted
+                num_deleted += deleted
+                page_results = {}
+                logger.info('Backfilled title keywords up to page %d', page_id)
+        if page_results:
+            inserted, deleted = WebPageUserKeywordResult.reconcile_results(
+                page_results, uk_ids)
+            num_inserted += inserted
+            num_deleted += deleted
+        return num_inserted, num_deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Backfill title-only user keyword results')
+    parser.add_argument('-min-page-id', dest='min_page_id', type=int,
+                        default=0, help='First page id to scan')
+    parser.add_argument('-max-page-id', dest='max_page_id', type=int,
+                        required=False, help='Last page id to scan')
+    parser.add_argument('-batch-size', dest='batch_size', type=int,
+                        default=TITLE_BATCH_SIZE,
+                        help='Pages per query and per result flush')
+    args = parser.parse_args()
+    start = time.time()
+    scanner = TitleKeywordScanner.from_db()
+    num_inserted, num_deleted = scanner.backfill_user_keyword_results(
+        args.min_page_id, args.max_page_id, args.batch_size)
+    logger.info('Inserted %d and deleted %d results in %.1f sec',
+                num_inserted, num_deleted, time.time() - start)
+
+if __name__ == '__main__':
+    main()
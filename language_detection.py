@@ -1,19 +1,40 @@
 from logging import getLogger
 
-from affine.model import Label, LanguageDetector
+from affine.model import Label, LanguageDetector, TextDetectorResult
+from affine.model.reference_data import reference_data, reference_lookup
+from .page_context import PageTextContext
 
 logger = getLogger(__name__)
 
 
 def process_page(page):
     """ Runs langid's language detection on webpage text"""
+    context = PageTextContext.of(page)
+    page = context.page
     logger.info("Detecting language for page: %d"%page.id)
-    lang_name = LanguageDetector.detect_language(page.title_and_text)
-    lang_label = Label.by_name(lang_name)
-    assert lang_label is not None, "Label %s does not exist"%lang_name
+    clf_target = _detect_language(context)
+    LanguageDetector.delete_detector_results(page, [clf_target.clf_id])
+    TextDetectorResult.log_result(page.id, clf_target.id)
+
+    return Label.get(clf_target.target_label_id)
+
 
-    det = LanguageDetector.query.one()
-    LanguageDetector.delete_detector_results(page, [det.id])
-    det.save_result(page.id, lang_label.id)
+def judge_page(page):
+    """Language detection without writing results.
 
-    return lang_label
+    Returns (ids of clf targets to log, ids of detectors whose results are
+    replaced), as the judge_page functions of the other text detectors do.
+    """
+    clf_target = _detect_language(PageTextContext.of(page))
+    return [clf_target.id], [clf_target.clf_id]
+
+
+def _detect_language(context):
+    """Clf target of the language of the page, from the reference data"""
+    lang_name = LanguageDetector.detect_language(context.title_and_text)
+    lang_label = reference_data().label_by_name(lang_name)
+    assert lang_label is not None, "Label %s does not exist"%lang_name
+    def lookup(ref):
+        det = ref.classifier_of(LanguageDetector)
+        return ref.clf_target(det.id, lang_label.id)
+    return reference_lookup(lookup)
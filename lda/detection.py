@@ -3,16 +3,20 @@ from scipy.sparse import csr_matrix
 import numpy as np
 import os
 import tempfile
+import threading
 
 from affine import config
-from affine.model import LdaDetector
+from affine.model import LdaDetector, TextDetectorResult
+from ..page_context import PageTextContext
 from ..topic_model import *
 from .lda_client import LdaClient
 
 logger = getLogger(__name__)
 
 INFER_LDA_JAR = os.path.join(config.bin_dir(), 'topic_model', 'InferLDA.jar')
-lda_model_lookup = {}
+# (detector id, updated_at) -> (config_obj, vocab_set), read once per process
+_detector_models = {}
+_detector_models_lock = threading.Lock()
 
 def temp_path():
     fd, path = tempfile.mkstemp()
@@ -22,40 +26,74 @@ def temp_path():
 
 def process_page(page, detectors):
     """Run lda detectors on webpage text"""
+    context = PageTextContext.of(page)
+    page = context.page
     logger.info("Running LDA detection on page %d", page.id)
-    global lda_model_lookup
-    lda_model_lookup = {}
+    clf_target_ids, detector_ids_to_delete = judge_page(context, detectors)
+    for clf_target_id in clf_target_ids:
+        TextDetectorResult.log_result(page.id, clf_target_id)
+    LdaDetector.delete_detector_results(page, detector_ids_to_delete)
+    logger.info("Finished LDA detection on page %d", page.id)
 
-    detectors = set(detectors)
-    detector_ids_to_delete = set()
 
-    for detector in detectors:
-        logger.info('Running LDA detection (page_id:%d detector:%s)', page.id, detector.name)
-        if classify_text(page.title_and_text, detector):
-            logger.info("LDA true detection (page_id:%d, detector:%s)", page.id, detector.name)
-            detector.save_result(page.id)
+def judge_page(page, detectors):
+    """Runs lda detectors without writing results.
+
+    Returns (ids of clf targets to log, ids of detectors whose results
+    should be deleted).
+    """
+    context = PageTextContext.of(page)
+    # topic distributions of this page by lda model id, so pages can be
+    # judged on several threads at once
+    topic_dists = {}
+
+    clf_target_ids = []
+    detector_ids_to_delete = set()
+    for detector in set(detectors):
+        logger.info('Running LDA detection (page_id:%d detector:%s)', context.id, detector.name)
+        if classify_text(context, detector, topic_dists):
+            logger.info("LDA true detection (page_id:%d, detector:%s)", context.id, detector.name)
+            clf_target_ids.append(detector.cached_clf_target().id)
         else:
             detector_ids_to_delete.add(detector.id)
+    return clf_target_ids, detector_ids_to_delete
 
-    LdaDetector.delete_detector_results(page, detector_ids_to_delete)
-    logger.info("Finished LDA detection on page %d", page.id)
 
+def classify_text(text, det, topic_dists=None):
+    """text is a string or a PageTextContext.
 
-def classify_text(text, det):
-    det.grab_files()
-    cfg_file = det.local_path(PipelineRunner.CFG_NAME)
-    config_obj = PipelineRunner.validate_config_file(cfg_file)
-    vocab_file = det.local_path(config_obj['vocab_file'])
-    with open(vocab_file) as fi:
-        vocab_set = set(fi.read().decode('utf-8').splitlines())
-    clean_text = TopicTrainer.preprocess_text(text, vocab_set)
+    topic_dists memoizes the topic distributions of this text by lda model
+    id. Only pass the same dict for the same text; a new one is used if it
+    is not given.
+    """
+    context = PageTextContext.of(text)
+    config_obj, vocab_set = load_detector_model(det)
+    clean_text = context.vocab_text(vocab_set)
     if not clean_text:
         return 0
-    topic_dist_sparse = mallet_infer_topics(clean_text, det, config_obj)
+    topic_dist_sparse = mallet_infer_topics(clean_text, det, config_obj,
+                                            topic_dists)
     pred = classify_topic_distribution(topic_dist_sparse, det, config_obj)
     return pred
 
 
+def load_detector_model(det):
+    """Config and vocabulary of an lda detector, downloaded and read the
+    first time this process sees the detector version"""
+    key = (det.id, det.updated_at)
+    with _detector_models_lock:
+        if key in _detector_models:
+            return _detector_models[key]
+        det.grab_files()
+        cfg_file = det.local_path(PipelineRunner.CFG_NAME)
+        config_obj = PipelineRunner.validate_config_file(cfg_file)
+        vocab_file = det.local_path(config_obj['vocab_file'])
+        with open(vocab_file) as fi:
+            vocab_set = set(fi.read().decode('utf-8').splitlines())
+        _detector_models[key] = config_obj, vocab_set
+        return config_obj, vocab_set
+
+
 def classify_topic_distribution(topic_dist_mat, det, config_obj):
     prediction_file = temp_path()
     topic_thresholds = config_obj['topic_thresholds']
@@ -71,20 +109,22 @@ def classify_topic_distribution(topic_dist_mat, det, config_obj):
     return pred
 
 
-def mallet_infer_topics(clean_text, det, config_obj):
-    topic_dist = memoized_infer_topics(clean_text, det.lda_model_id)
+def mallet_infer_topics(clean_text, det, config_obj, topic_dists=None):
+    topic_dist = memoized_infer_topics(clean_text, det.lda_model_id,
+                                       topic_dists)
     n_ftrs = config_obj['mallet_train']['num-topics']
     sparse_mat = topic_dist_to_sparse(topic_dist, n_ftrs)
     return sparse_mat
 
 
-def memoized_infer_topics(clean_text, lda_model_id):
-    global lda_model_lookup
+def memoized_infer_topics(clean_text, lda_model_id, topic_dists=None):
+    if topic_dists is None:
+        topic_dists = {}
     try:
-        topic_dist = lda_model_lookup[lda_model_id]
+        topic_dist = topic_dists[lda_model_id]
     except KeyError:
         topic_dist = LdaClient.infer_topics(clean_text, lda_model_id)
-        lda_model_lookup[lda_model_id] = topic_dist
+        topic_dists[lda_model_id] = topic_dist
     return topic_dist
 
 
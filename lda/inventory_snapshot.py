@@ -0,0 +1,161 @@
+"""Packed snapshot of the title, text and domain of inventory pages.
+
+The snapshot is written in one pass over the inventory and read back with
+mmap, so any page can be looked up by id without loading the file.
+
+File layout (all integers little-endian):
+    8 bytes   magic
+    blobs     UTF-8 title then text of every page, in page id order
+    sections  numpy arrays, each 8 byte aligned:
+                page_ids     sorted page ids
+                offsets      2 * num_pages + 1 positions in the blobs; page i
+                             has title offsets[2i]:offsets[2i+1] and text
+                             offsets[2i+1]:offsets[2i+2]
+                domain_ids   index into the domain list of every page
+    footer    JSON dict with the domain list and the (offset, dtype, shape)
+              of every section, relative to the start of the file
+    8 bytes   footer length (uint64)
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from logging import getLogger
+
+import numpy as np
+
+from affine.model import session, WebPage, WebPageInventory
+from affine.model.web_pages import iter_page_texts
+
+__all__ = ['InventorySnapshot', 'build_inventory_snapshot']
+
+logger = getLogger(__name__)
+
+MAGIC = 'AINVSNP1'
+ALIGNMENT = 8
+CHUNK_SIZE = 10000
+
+
+def build_inventory_snapshot(path, page_ids=None, chunk_size=CHUNK_SIZE):
+    """Writes a snapshot of page_ids (all inventory pages if None) to path.
+
+    Pages that are not in web_pages are left out. Returns the number of
+    pages written.
+    """
+    if page_ids is None:
+        page_ids = [i for (i,) in session.query(WebPageInventory.page_id)]
+    page_ids = sorted(set(page_ids))
+    written_ids = array('l')
+    offsets = array('l')
+    domain_ids = array('l')
+    domains = {}
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            fo.write(MAGIC)
+            for i in xrange(0, len(page_ids), chunk_size):
+                logger.info('Snapshotting chunk (%d / %d)', i / chunk_size + 1,
+                            (len(page_ids) + chunk_size - 1) / chunk_size)
+                id_chunk = page_ids[i:i + chunk_size]
+                query = session.query(WebPage.id, WebPage.title, WebPage.domain)
+                pages = {row[0]: row[1:] for row in
+                         query.filter(WebPage.id.in_(id_chunk))}
+                id_chunk = [page_id for page_id in id_chunk if page_id in pages]
+                for page_id, text in iter_page_texts(id_chunk, silent=True):
+                    title, domain = pages[page_id]
+                    written_ids.append(page_id)
+                    offsets.append(fo.tell() - len(MAGIC))
+                    fo.write((title or u'').encode('utf-8'))
+                    offsets.append(fo.tell() - len(MAGIC))
+                    fo.write(text.encode('utf-8'))
+                    domain_ids.append(domains.setdefault(domain, len(domains)))
+            offsets.append(fo.tell() - len(MAGIC))
+
+            arrays = {
+                'page_ids': np.asarray(written_ids, dtype=np.int64),
+                'offsets': np.asarray(offsets, dtype=np.int64),
+                'domain_ids': np.asarray(domain_ids, dtype=np.int32),
+            }
+            sections = {}
+            for name in sorted(arrays):
+                fo.write('\0' * (-fo.tell() % ALIGNMENT))
+                sections[name] = [fo.tell(), arrays[name].dtype.str,
+                                  list(arrays[name].shape)]
+                fo.write(arrays[name].tostring())
+            domain_list = sorted(domains, key=domains.get)
+            footer = json.dumps({'sections': sections, 'domains': domain_list})
+            fo.write(footer)
+            fo.write(struct.pack('<Q', len(footer)))
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    logger.info('Wrote inventory snapshot %s (%d pages)', path, len(written_ids))
+    return len(written_ids)
+
+
+class InventorySnapshot(object):
+    """Read-only, memory-mapped view of an inventory snapshot.
+
+    Rows are numbered in page id order. Iterating yields
+    (page_id, title, text, domain) for every page.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fi:
+            self._mmap = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._mmap[:len(MAGIC)] == MAGIC, \
+            'Not an inventory snapshot: %s' % path
+        size = len(self._mmap)
+        footer_len, = struct.unpack('<Q', self._mmap[size - 8:])
+        footer = json.loads(self._mmap[size - 8 - footer_len:size - 8])
+        self.domains = footer['domains']
+        for name, (offset, dtype, shape) in footer['sections'].iteritems():
+            count = int(np.prod(shape))
+            section = np.frombuffer(self._mmap, dtype=dtype, count=count,
+                                    offset=offset)
+            setattr(self, name, section.reshape(shape))
+
+    def close(self):
+        self._mmap.close()
+
+    def __len__(self):
+        return len(self.page_ids)
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield (int(self.page_ids[row]), self.title(row), self.text(row),
+                   self.domain(row))
+
+    def _blob(self, start, end):
+        start += len(MAGIC)
+        end += len(MAGIC)
+        return self._mmap[start:end].decode('utf-8')
+
+    def row(self, page_id):
+        """Row of page_id, or None if the page is not in the snapshot"""
+        row = int(np.searchsorted(self.page_ids, page_id))
+        if row < len(self) and self.page_ids[row] == page_id:
+            return row
+        return None
+
+    def title(self, row):
+        return self._blob(self.offsets[2 * row], self.offsets[2 * row + 1])
+
+    def text(self, row):
+        return self._blob(self.offsets[2 * row + 1], self.offsets[2 * row + 2])
+
+    def domain(self, row):
+        return self.domains[self.domain_ids[row]]
+
+    def get(self, page_id):
+        """(title, text, domain) of page_id, or None if it is not included"""
+        row = self.row(page_id)
+        if row is None:
+            return None
+        return self.title(row), self.text(row), self.domain(row)
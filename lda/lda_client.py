@@ -30,7 +30,8 @@ class LdaClient(object):
 
     @classmethod
     def query_and_parse(cls, args_dict):
-        response_json = cls._query_server(args_dict, timeout=cls.INFER_TIMEOUT)
+        timeout = config.get('lda_server.timeout', cls.INFER_TIMEOUT)
+        response_json = cls._query_server(args_dict, timeout=timeout)
         return cls._parse_json(response_json)
 
     @classmethod
@@ -4,8 +4,7 @@ import os
 import warnings
 from collections import defaultdict
 from logging import getLogger
-from math import ceil
-from tempfile import mkstemp
+from tempfile import mkdtemp
 from validate import Validator
 
 from configobj import ConfigObj
@@ -17,13 +16,16 @@ from affine.model import *
 from affine import config
 from affine.aws.s3client import download_tarball
 from affine.detection.nlp.topic_model import TopicTrainer
+from .inventory_snapshot import InventorySnapshot, build_inventory_snapshot
 
 logger = getLogger(__name__)
 
 warnings.simplefilter('ignore', SparseEfficiencyWarning)
 
-CHUNK_SIZE = 10000
 STOP_THRESH = 0.5
+INVENTORY_SNAPSHOT = 'inventory_snapshot'
+# Line files of the old inventory dump, for the deprecated input_file and
+# page_ids_file arguments
 PAGE_TITLE = 'page_title'
 PAGE_TEXT = 'page_text'
 PAGE_ID = 'page_id'
@@ -63,23 +65,8 @@ class InventoryTopicModeler(object):
         self.config_obj = self.validate_config_file(config_file)
 
     @staticmethod
-    def grab_inventory_text():
-        page_ids = sorted([i for (i,) in session.query(WebPageInventory.page_id)])
-        n_chunks = ceil(len(page_ids)/float(CHUNK_SIZE))
-        with open(PAGE_ID, 'w') as fo1, open(PAGE_TEXT, 'w') as fo2, open(PAGE_TITLE, 'w') as fo3, open(PAGE_DOMAIN, 'w') as fo4:
-            for i in xrange(0, len(page_ids), CHUNK_SIZE):
-                logger.info('Processing chunk (%d / %d)'%(i/CHUNK_SIZE + 1, n_chunks))
-                id_chunk = page_ids[i:i+CHUNK_SIZE]
-                query = session.query(WebPage.id, WebPage.title, WebPage.domain).filter(WebPage.id.in_(id_chunk))
-                text_dict = web_pages.get_page_text_dict(id_chunk)
-                for pg_id, pg_title, pg_domain in query:
-                    try:
-                        fo1.write('%s\n'%pg_id)
-                        fo2.write(text_dict[pg_id].encode('utf-8')+'\n')
-                        fo3.write(pg_title.encode('utf-8')+'\n')
-                        fo4.write(pg_domain.encode('utf-8')+'\n')
-                    except Exception, e:
-                        logger.exception('page-id: %s' %pg_id)
+    def grab_inventory_text(snapshot_file=INVENTORY_SNAPSHOT):
+        build_inventory_snapshot(snapshot_file)
 
     @classmethod
     def validate_config_file(cls, config_file):
@@ -96,12 +83,14 @@ class InventoryTopicModeler(object):
         TopicTrainer.get_resource_file(VOCAB_FILE)
         self.fetch_domain_stopwords()
         vocab_set = set(open(VOCAB_FILE).read().decode('utf-8').splitlines())
-        with open(self.config_obj['mallet_import']['input'],'w') as fo, open(PAGE_TITLE) as fi1, open(PAGE_TEXT) as fi2, open(PAGE_DOMAIN) as fi3:
-            for title, text, domain in zip(fi1, fi2, fi3):
+        snapshot = InventorySnapshot(INVENTORY_SNAPSHOT)
+        with open(self.config_obj['mallet_import']['input'],'w') as fo:
+            for _, title, text, domain in snapshot:
                 title_and_text =  title.strip() + ' ' + text.strip()
-                clean_text = TopicTrainer.preprocess_text(title_and_text.decode('utf-8'), vocab_set)
-                clean_text = self.clean_domain(clean_text, domain.strip())
+                clean_text = TopicTrainer.preprocess_text(title_and_text, vocab_set)
+                clean_text = self.clean_domain(clean_text, domain)
                 fo.write(clean_text.encode('utf-8') + '\n')
+        snapshot.close()
 
     def fetch_domain_stopwords(self):
         self.stop_dict = defaultdict(set)
@@ -139,7 +128,8 @@ class InventoryTopicModeler(object):
                 fo.write('%d\n'%len(nzs))
 
     @classmethod
-    def create_text_file(cls, topic_id_list, libsvm_file=LIBSVM_FILE, input_file=PAGE_TITLE, n_ftrs=None, topic_threshold=None, op_file='output_trues'):
+    def matching_rows(cls, topic_id_list, libsvm_file=LIBSVM_FILE, n_ftrs=None, topic_threshold=None):
+        """Sorted snapshot rows of the documents that have any of the topics"""
         if n_ftrs is None:
             n_ftrs = InventoryTopicModeler.validate_config_file(None)['mallet_train']['num-topics']
         x_test, _ = load_svmlight_file(libsvm_file, n_ftrs, zero_based=True)
@@ -151,20 +141,53 @@ class InventoryTopicModeler(object):
             sum_col = sum_col + x_test.getcol(topic_id)
 
         nzs, _ = sum_col.nonzero()
-        nzs = set(nzs)
-        num_res = 0
+        return sorted(set(nzs))
+
+    @classmethod
+    def create_text_file(cls, topic_id_list, libsvm_file=LIBSVM_FILE, input_file=None, n_ftrs=None, topic_threshold=None, op_file='output_trues', snapshot_file=INVENTORY_SNAPSHOT, column='title'):
+        """Writes the page_id, title, text or domain of the matching documents.
+
+        input_file is deprecated: it is a file with one line per document,
+        as grab_inventory_text used to write, and the matching lines are
+        copied from it instead of reading the snapshot.
+        """
+        rows = cls.matching_rows(topic_id_list, libsvm_file=libsvm_file, n_ftrs=n_ftrs, topic_threshold=topic_threshold)
+        if input_file is not None:
+            warnings.warn('input_file is deprecated, use snapshot_file and column',
+                          DeprecationWarning, stacklevel=2)
+            values = _matching_lines(input_file, rows)
+            with open(op_file,'w') as fo:
+                for value in values:
+                    fo.write('%s\n'%value)
+                print 'Number of results = %d'%len(values)
+            return
+        snapshot = InventorySnapshot(snapshot_file)
         with open(op_file,'w') as fo:
-            for i, ll in enumerate(open(input_file)):
-                if i in nzs:
-                    fo.write('%s\n'%(ll.strip()))
-                    num_res += 1
-            print 'Number of results = %d'%num_res
+            for i in rows:
+                if column == 'page_id':
+                    value = unicode(snapshot.page_ids[i])
+                else:
+                    value = getattr(snapshot, column)(i)
+                fo.write('%s\n'%(' '.join(value.split()).encode('utf-8')))
+            print 'Number of results = %d'%len(rows)
+        snapshot.close()
 
     @classmethod
-    def estimate_recall(cls, label_id, topic_id_list, page_ids_file=PAGE_ID, libsvm_file=LIBSVM_FILE, n_ftrs=None, topic_threshold=None, missed_file=None):
-        h, op_file = mkstemp(); os.close(h)
-        cls.create_text_file(topic_id_list, libsvm_file=libsvm_file, input_file=page_ids_file, n_ftrs=n_ftrs, topic_threshold=topic_threshold, op_file=op_file)
-        tm_page_ids = {int(i) for i in open(op_file).read().splitlines()}
+    def estimate_recall(cls, label_id, topic_id_list, page_ids_file=None, libsvm_file=LIBSVM_FILE, n_ftrs=None, topic_threshold=None, missed_file=None, snapshot_file=INVENTORY_SNAPSHOT):
+        """Fraction of the pages matching the topics that have the label.
+
+        page_ids_file is deprecated: it is a file with the page id of every
+        document on its own line, read instead of the snapshot.
+        """
+        rows = cls.matching_rows(topic_id_list, libsvm_file=libsvm_file, n_ftrs=n_ftrs, topic_threshold=topic_threshold)
+        if page_ids_file is not None:
+            warnings.warn('page_ids_file is deprecated, use snapshot_file',
+                          DeprecationWarning, stacklevel=2)
+            tm_page_ids = {int(i) for i in _matching_lines(page_ids_file, rows)}
+        else:
+            snapshot = InventorySnapshot(snapshot_file)
+            tm_page_ids = {int(snapshot.page_ids[i]) for i in rows}
+            snapshot.close()
         # Count wplr True matches for the "true" pages
         query = session.query(WebPageLabelResult.page_id).filter_by(label_id=label_id).filter(WebPageLabelResult.page_id.in_(tm_page_ids))
         wplr_page_ids = {i for (i,) in query}
@@ -176,9 +199,14 @@ class InventoryTopicModeler(object):
         if missed_file:
             with open(missed_file, 'w') as fo:
                 fo.write('\n'.join([str(i) for i in missed_page_ids]))
-        os.unlink(op_file)
         return recall
 
+def _matching_lines(path, rows):
+    """Stripped lines of a file with one line per document, for the rows"""
+    rows = set(rows)
+    with open(path) as fi:
+        return [ll.strip() for i, ll in enumerate(fi) if i in rows]
+
 def run_pipeline(config_file, model_dir):
     cwdir = os.getcwd()
     os.chdir(model_dir)
@@ -3,7 +3,9 @@ import unicodedata
 from logging import getLogger
 
 from affine import config
-from affine.model import Label, NamedEntityClassifier, TextDetectorResult, ClassifierTarget
+from affine.model import NamedEntityClassifier, TextDetectorResult
+from affine.model.reference_data import reference_lookup
+from ..page_context import PageTextContext
 
 logger = getLogger(__name__)
 
@@ -11,20 +13,35 @@ logger = getLogger(__name__)
 DBPEDIA_PREFIX = 'DBpedia:'
 BLACK_LISTED_SURFACE_FORMS = ['youtube']
 MAX_TEXT_LEN = 10000
+SPOTLIGHT_TIMEOUT = 30
 
 
 def process_page(page, clfs):
     """ Runs Named Entity classification on a page"""
+    context = PageTextContext.of(page)
+    page = context.page
     logger.info("Running NEC detection on page %d" % page.id)
+    clf_target_ids, clf_ids = judge_page(context, clfs)
+    NamedEntityClassifier.delete_detector_results(page, clf_ids)
+    for clf_target_id in clf_target_ids:
+        TextDetectorResult.log_result(page.id, clf_target_id)
+
+
+def judge_page(page, clfs):
+    """Named Entity classification without writing results.
+
+    Returns (ids of clf targets to log, ids of classifiers whose results are
+    replaced).
+    """
+    context = PageTextContext.of(page)
     # We only supprt one classifier currently
     assert len(clfs) == 1
-    true_clf_targets = classify_title(page)
-    clf = clfs[0]
-    NamedEntityClassifier.delete_detector_results(page, [clf.id])
-    for clf_target in true_clf_targets:
+    clf_target_ids = []
+    for clf_target in classify_title(context):
         logger.info("NEC true detection (page_id:%d, clf_target_id:%s)" %
-                    (page.id, clf_target.id))
-        TextDetectorResult.log_result(page.id, clf_target.id)
+                    (context.id, clf_target.id))
+        clf_target_ids.append(clf_target.id)
+    return clf_target_ids, [clfs[0].id]
 
 
 def classify_title(page):
@@ -32,15 +49,17 @@ def classify_title(page):
     Classfies the title of the page via the NamedEntityClassifier.
 
     Args:
-        page: The page object that need to be classified.
+        page: The page object or PageTextContext that need to be classified.
 
     Returns:
-        A list with all the DBpedia lables present in the title.
+        A list with the clf targets of all the DBpedia lables present in
+        the title, as (id, clf_id, target_label_id) tuples.
     """
-    full_annotation = spotlight_annotate(page.title_and_text)
+    context = PageTextContext.of(page)
+    full_annotation = spotlight_annotate(context.title_and_text)
 
     entity_types = set()
-    title_offset = len(page.title)
+    title_offset = context.title_offset
 
     for entity in full_annotation:
         if int(entity['offset']) >= title_offset:
@@ -60,20 +79,27 @@ def _get_canonical_types(types):
 
 
 def _get_matching_clf_targets(entity_types):
+    """(id, clf_id, target_label_id) of the clf targets of the
+    NamedEntityClassifier whose label is one of entity_types"""
     if not entity_types:
         return []
-    clf = NamedEntityClassifier.query.one()
-    return ClassifierTarget.query.filter(ClassifierTarget.clf_id == clf.id).join(Label, ClassifierTarget.target_label_id == Label.id).filter(Label.name.in_(entity_types)).all()
+    entity_types = set(entity_types)
+    def lookup(ref):
+        clf = ref.classifier_of(NamedEntityClassifier)
+        return [clf_target for clf_target in ref.clf_targets_of(clf.id)
+                if ref.label(clf_target.target_label_id).name in entity_types]
+    return reference_lookup(lookup)
 
 
-def spotlight_annotate(text, confidence=0.5, support=20, timeout=30):
+def spotlight_annotate(text, confidence=0.5, support=20, timeout=None):
     """
     Annotates the text using spotlight.
 
     Args:
         text: The text that should be annotated.
         confidence, support: Internal spotlight parameters.
-        timeout: Wait time before the server is considered timed out.
+        timeout: Wait time before the server is considered timed out,
+            spotlight_server.timeout (30 seconds by default) if not given.
 
     Returns:
         A list of dics containing the results of the classification.
@@ -89,6 +115,8 @@ def spotlight_annotate(text, confidence=0.5, support=20, timeout=30):
     if text.strip() == '':
         return []
     spotlight_address = config.get('spotlight_server.address') + "/annotate/"
+    if timeout is None:
+        timeout = config.get('spotlight_server.timeout', SPOTLIGHT_TIMEOUT)
 
 
     data = {'confidence': confidence, 'support': support, 'text': text}
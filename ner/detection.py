@@ -4,50 +4,86 @@ import os
 import socket
 
 import signal
+import threading
 
 import numpy as np
 from logging import getLogger
 
 from affine.detection.model.features import NerFeatureExtractor
-from affine.model import NerDetector
+from affine.model import NerDetector, TextDetectorResult
 from affine.detection.model.classifiers import LibsvmClassifier
+from ..page_context import PageTextContext
 
 logger = getLogger(__name__)
 
+# (detector id, updated_at) -> LibsvmClassifier
+_svm_models = {}
+_svm_models_lock = threading.Lock()
+
 
 def process_page(page, detectors):
     """ Runs NER classification on a page"""
+    page = PageTextContext.of(page).page
     logger.info("Running NER detection on page %d"%page.id)
+    judgement = judge_page(page, detectors)
+    if judgement is None:
+        return
+    clf_target_ids, detector_ids_to_delete = judgement
+    for clf_target_id in clf_target_ids:
+        TextDetectorResult.log_result(page.id, clf_target_id)
+    NerDetector.delete_detector_results(page, detector_ids_to_delete)
+
+
+def judge_page(page, detectors):
+    """NER classification without writing results.
+
+    Returns (ids of clf targets to log, ids of detectors whose results
+    should be deleted), or None if the page was skipped and its results
+    should be left alone.
+    """
+    page_id = PageTextContext.of(page).id
     nfe = NerFeatureExtractor()
     try:
-        ftr_dict = nfe.extract(page.id)
+        ftr_dict = nfe.extract(page_id)
     except socket.timeout:
         logger.exception("Skipping NER due to timeout")
         # Kill server to recover from bad state.
         # The server should be started automatically for next detection
         _kill_ner_server()
-        return
+        return None
 
+    clf_target_ids = []
     matching_detectors = set()
     for det in detectors:
-        ftrs = ftr_dict.get(det.clf_target.target_label_id)
+        clf_target = det.cached_clf_target()
+        ftrs = ftr_dict.get(clf_target.target_label_id)
         if ftrs is not None:
             if classify_ftrs(ftrs, det):
-                logger.info("NER true detection (page_id:%d, detector:%s)"%(page.id, det.name))
-                det.save_result(page.id)
+                logger.info("NER true detection (page_id:%d, detector:%s)"%(page_id, det.name))
+                clf_target_ids.append(clf_target.id)
                 matching_detectors.add(det)
     detectors_to_delete = set(detectors) - matching_detectors
-    detector_ids_to_delete = [detector.id for detector in detectors_to_delete]
-    NerDetector.delete_detector_results(page, detector_ids_to_delete)
+    return clf_target_ids, [detector.id for detector in detectors_to_delete]
 
 
 def classify_ftrs(ftrs, det):
-    det.grab_files()
-    model_file = det.local_path(NerDetector.SVM_MODEL)
-    clf = LibsvmClassifier.load_from_file(model_file)
+    clf = load_svm_model(det)
     return clf.predict(np.asarray([ftrs]))[0]
 
 
+def load_svm_model(det):
+    """SVM of a NER detector, loaded the first time this process sees the
+    detector version"""
+    key = (det.id, det.updated_at)
+    with _svm_models_lock:
+        if key in _svm_models:
+            return _svm_models[key]
+        det.grab_files()
+        model_file = det.local_path(NerDetector.SVM_MODEL)
+        clf = _svm_models[key] = LibsvmClassifier.load_from_file(model_file)
+        return clf
+
+
 def _kill_ner_server():
     logger.info('Killing NER server because it is in a bad state')
     proc = subprocess.Popen(["pgrep", '-f', 'NERServer'], stdout=subprocess.PIPE)
@@ -0,0 +1,171 @@
+"""Text of one web page shared by all the text detectors that run on it.
+
+The page text is downloaded once and every derived form is computed the
+first time a detector asks for it. Detectors running on several threads
+wait for a form another thread is computing instead of computing it again.
+"""
+import sys
+import threading
+import unicodedata
+from logging import getLogger
+
+__all__ = ['PageTextContext', 'control_characters_table']
+
+logger = getLogger(__name__)
+
+# Unicode categories removed from text sent to the topic model servers
+CONTROL_CATEGORIES = ('Zp', 'Zl', 'Cf', 'Cc')
+
+_control_table = None
+
+
+def control_characters_table():
+    """unicode.translate table that deletes CONTROL_CATEGORIES characters"""
+    global _control_table
+    if _control_table is None:
+        _control_table = {i: None for i in xrange(sys.maxunicode)
+                          if unicodedata.category(unichr(i)) in CONTROL_CATEGORIES}
+    return _control_table
+
+
+class PageTextContext(object):
+    """Lazily computed text of a web page, or of a bare piece of text.
+
+    Detector entry points take a WebPage, a PageTextContext or (where they
+    used to take text) a string, and turn it into a context with `of`.
+    """
+
+    def __init__(self, page=None, text=None):
+        self.page = page
+        self._text = text
+        self._cache = {}
+        # key -> lock held while its value is computed
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @classmethod
+    def of(cls, page_or_text):
+        if isinstance(page_or_text, cls):
+            return page_or_text
+        if isinstance(page_or_text, basestring):
+            return cls(text=page_or_text)
+        return cls(page=page_or_text)
+
+    @classmethod
+    def prefetch(cls, contexts):
+        """Downloads the page text of many contexts concurrently.
+
+        Contexts whose text is missing or fails to download are left alone,
+        so description_text raises the same error as WebPage.description_text.
+        """
+        from affine.model.web_pages import iter_raw_page_texts
+        from affine.model.page_text_encoding import decode_page_text
+        pending = {}
+        for context in contexts:
+            if context.page is None or 'description_text' in context._cache:
+                continue
+            if context.page.s3_page_text:
+                pending[context.page.id] = context
+            else:
+                context._cache['description_text'] = None
+        try:
+            for page_id, text in iter_raw_page_texts(sorted(pending)):
+                if text is not None:
+                    pending[page_id]._cache['description_text'] = \
+                        decode_page_text(text).decode('utf-8')
+        except Exception:
+            logger.exception('Page text prefetch failed, the remaining pages '
+                             'are downloaded one at a time')
+
+    def _memoize(self, key, func):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            try:
+                return self._cache[key]
+            except KeyError:
+                value = self._cache[key] = func()
+                return value
+
+    @property
+    def id(self):
+        return self.page.id if self.page is not None else None
+
+    @property
+    def title(self):
+        if self.page is None:
+            return u''
+        return self.page.title or u''
+
+    @property
+    def title_offset(self):
+        """Position in title_and_text where the page text starts"""
+        return len(self.title)
+
+    @property
+    def description_text(self):
+        if self.page is None:
+            return self._text
+        return self._memoize('description_text',
+                             lambda: self.page.description_text)
+
+    @property
+    def title_and_text(self):
+        """Same as WebPage.title_and_text, or the text of a bare context"""
+        if self.page is None:
+            return self._text
+        def title_and_text():
+            text = self.title
+            desc_text = self.description_text
+            if desc_text:
+                text += ' ' + desc_text
+            return text
+        return self._memoize('title_and_text', title_and_text)
+
+    @property
+    def utf8_text(self):
+        """title_and_text encoded as utf-8"""
+        return self._memoize('utf8_text',
+                             lambda: self.title_and_text.encode('utf-8'))
+
+    @property
+    def control_stripped_text(self):
+        """title_and_text without control and line/paragraph separators"""
+        return self._memoize('control_stripped_text',
+                             lambda: self.title_and_text.translate(
+                                 control_characters_table()))
+
+    @property
+    def topic_tokens(self):
+        """title_and_text tokenized and plural-stemmed for topic modeling"""
+        from .topic_model.topic_train import TopicTrainer
+        return self._memoize('topic_tokens',
+                             lambda: TopicTrainer.tokenize_text(self.title_and_text))
+
+    def vocab_text(self, vocab_set):
+        """Same as TopicTrainer.preprocess_text(title_and_text, vocab_set)"""
+        return ' '.join(w for w in self.topic_tokens if w in vocab_set)
+
+    @property
+    def processed_title(self):
+        if self.page is not None:
+            return self.page.processed_title
+        return []
+
+    @property
+    def processed_text(self):
+        """Keyword matching tokens of the page text"""
+        def processed_text():
+            from .keywords.keyword_matching import process_text
+            text = self.description_text
+            if text is None:
+                return None
+            return process_text(text)
+        return self._memoize('processed_text', processed_text)
+
+    # lets LabelKeywordScorer.score_page take a context
+    processed_description_text = processed_text
@@ -0,0 +1,125 @@
+"""Re-encodes stored page text objects with the configured encoding.
+
+Pages are read in id order and objects that are already in the target
+encoding are skipped, unless they are compressed but were uploaded without
+a Content-Encoding header, so the tool can be stopped and resumed from the last
+logged page id. Right before an object is rewritten its ETag is compared
+with the MD5 of the bytes that were re-encoded, and it is left alone if the
+page text was uploaded again in the meantime. S3 has no conditional PUT, so
+an upload landing between that check and the write can still be replaced.
+
+    python -m affine.detection.nlp.reencode_page_text -encoding zstd
+"""
+import argparse
+import hashlib
+import threading
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+from affine import config
+from affine.aws import s3client
+from affine.model import session, WebPage
+from affine.model.page_text_encoding import encode_page_text, \
+    decode_page_text, page_text_encoding, upload_encoding, ENCODINGS
+from affine.model.web_pages import PageTextFetcher, \
+    PAGE_TEXT_FETCH_THREADS, put_page_text_object
+
+__all__ = ['reencode_page_texts']
+
+logger = getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def _page_ids_with_text(min_page_id, batch_size):
+    """Batches of ids of pages with page text, in id order"""
+    last_id = min_page_id - 1
+    while True:
+        query = session.query(WebPage.id).filter(WebPage.s3_page_text == True)
+        query = query.filter(WebPage.id > last_id).order_by(WebPage.id)
+        page_ids = [page_id for (page_id,) in query.limit(batch_size)]
+        if not page_ids:
+            return
+        yield page_ids
+        last_id = page_ids[-1]
+
+
+def reencode_page_texts(encoding, min_page_id=0, batch_size=BATCH_SIZE,
+                        num_threads=PAGE_TEXT_FETCH_THREADS):
+    """Rewrites every page text object not stored in encoding, or stored
+    compressed without a Content-Encoding header.
+
+    Returns (num_reencoded, num_skipped).
+    """
+    bucket = config.s3_bucket()
+    fetcher = PageTextFetcher(num_threads=num_threads)
+    upload_pool = ThreadPool(num_threads)
+    local = threading.local()
+
+    def upload((page_id, old_data, data)):
+        """Replaces old_data with data, False if the object changed"""
+        try:
+            bucket_conn = local.conn
+        except AttributeError:
+            bucket_conn = local.conn = s3client.connect(bucket)
+        urlpath = "%s/%s" % ('page_text', page_id)
+        key = bucket_conn.get_key(urlpath)
+        if key is None or \
+                key.etag.strip('"') != hashlib.md5(old_data).hexdigest():
+            logger.info('Page text of page %d changed, not re-encoding it',
+                        page_id)
+            return False
+        if data is old_data and \
+                key.content_encoding == page_text_encoding(data):
+            return False
+        put_page_text_object(bucket_conn, urlpath, data)
+        return True
+
+    num_reencoded = num_skipped = 0
+    try:
+        for page_ids in _page_ids_with_text(min_page_id, batch_size):
+            uploads = []
+            for page_id, data in fetcher.iter_raw_page_texts(page_ids):
+                if data is None:
+                    num_skipped += 1
+                elif page_text_encoding(data) == encoding:
+                    if encoding is None:
+                        num_skipped += 1
+                    else:
+                        # only rewritten if its header is missing
+                        uploads.append((page_id, data, data))
+                else:
+                    uploads.append((page_id, data, encode_page_text(
+                        decode_page_text(data), encoding)))
+            num_uploaded = sum(upload_pool.map(upload, uploads))
+            num_reencoded += num_uploaded
+            num_skipped += len(uploads) - num_uploaded
+            logger.info('Re-encoded page text up to page %d (%d re-encoded, '
+                        '%d skipped)', page_ids[-1], num_reencoded, num_skipped)
+    finally:
+        upload_pool.close()
+        upload_pool.join()
+        fetcher.close()
+    return num_reencoded, num_skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Re-encode page text objects in S3')
+    parser.add_argument('-encoding', dest='encoding', choices=['gzip', 'zstd', 'none'],
+                        required=False,
+                        help='Target encoding, affine.page_text.encoding if not given')
+    parser.add_argument('-min-page-id', dest='min_page_id', type=int,
+                        default=0, help='First page id to re-encode')
+    parser.add_argument('-batch-size', dest='batch_size', type=int,
+                        default=BATCH_SIZE, help='Pages per batch')
+    args = parser.parse_args()
+    if args.encoding is None:
+        encoding = upload_encoding()
+    else:
+        encoding = None if args.encoding == 'none' else args.encoding
+    assert encoding in ENCODINGS
+    reencode_page_texts(encoding, args.min_page_id, args.batch_size)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,45 @@
 from logging import getLogger
+import threading
 
 from affine import config
 from affine.model import Label, SentimentClassifier, TextDetectorResult, ClassifierTarget
 from sa.sent_analysis.Lexicon import SentiLexicon
 from sa.sent_analysis.Lexical_Classifier import LexicalClassifier
+from ..page_context import PageTextContext
 
 logger = getLogger(__name__)
 
 MIN_CHARS_TO_PREDICT = 1000
 
+_classifier = None
+_classifier_lock = threading.Lock()
+
 def process_page(page, clfs):
     """ Runs Sentitiment Analysis classification on a page"""
+    context = PageTextContext.of(page)
+    page = context.page
     logger.info("Running SA detection on page {}".format(page.id))
+    clf_target_ids, clf_ids = judge_page(context, clfs)
+    SentimentClassifier.delete_detector_results(page, clf_ids)
+    for clf_target_id in clf_target_ids:
+        TextDetectorResult.log_result(page.id, clf_target_id)
+
+
+def judge_page(page, clfs):
+    """Sentiment classification without writing results.
+
+    Returns (ids of clf targets to log, ids of classifiers whose results are
+    replaced).
+    """
+    context = PageTextContext.of(page)
     assert len(clfs) == 1, 'we currently support only one classifier'
     clf = clfs[0]
-    SentimentClassifier.delete_detector_results(page, [clf.id])
     # API expects utf8 encoded text
-    is_negative = text_has_negative_sentiment(page.title_and_text.encode('utf-8'))
+    is_negative = text_has_negative_sentiment(context.utf8_text)
     if is_negative:
-        logger.info("Sentiment for page_id {} is negative".format(page.id))
-        TextDetectorResult.log_result(page.id, clf.clf_target.id)
+        logger.info("Sentiment for page_id {} is negative".format(context.id))
+        return [clf.cached_clf_target().id], [clf.id]
+    return [], [clf.id]
 
 
 def text_has_negative_sentiment(text, threshold=.8):
@@ -27,8 +47,16 @@ def text_has_negative_sentiment(text, threshold=.8):
     if len(text) < MIN_CHARS_TO_PREDICT:
         return False
 
-    lexicon = SentiLexicon()
-    classifier = LexicalClassifier(lexicon)
+    classifier = lexical_classifier()
     neg_score = classifier.classify(text , cumulative=False)[1][1]
     return neg_score > threshold
 
+
+def lexical_classifier():
+    """Lexical classifier, built once per process since reading the
+    lexicon is slow"""
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            _classifier = LexicalClassifier(SentiLexicon())
+    return _classifier
@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from affine import config
+from affine.model import detector_logging
+from affine.model.detector_logging import detach_detector_log, \
+    detector_log_many, merge_detector_logs, rotate_detector_log
+
+
+def _log_in_worker(conn, page_id):
+    """What a text worker does with the detector log of one batch"""
+    detach_detector_log()
+    detector_log_many([('TDR', page_id, 2)])
+    conn.send(rotate_detector_log())
+
+
+class TestWorkerDetectorLogs(TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.old_log_dir = config.get('affine.log.dir')
+        config.set('affine.log.dir', self.log_dir)
+        detach_detector_log()
+
+    def tearDown(self):
+        detach_detector_log()
+        config.set('affine.log.dir', self.old_log_dir)
+        shutil.rmtree(self.log_dir)
+
+    def _run_worker(self, page_id):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=_log_in_worker,
+                                       args=(writer, page_id))
+        proc.start()
+        writer.close()
+        path = reader.recv()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+        return path, proc.pid
+
+    def test_restarted_workers_keep_their_own_logs(self):
+        # the parent has a log of its own once it merged worker logs
+        merge_detector_logs([])
+        parent_path = detector_logging._log_path
+        detector_log_many([('TDR', 1, 1)])
+
+        # a worker and the one that replaces it, both forked afterwards
+        worker_logs = [self._run_worker(page_id) for page_id in (2, 3)]
+
+        self.assertEqual(open(parent_path).read().splitlines(),
+                         ['TDR\t1\t1'])
+        for page_id, (path, pid) in zip((2, 3), worker_logs):
+            self.assertTrue(os.path.basename(path).startswith(
+                'detector_log-%d.log.' % pid))
+            self.assertEqual(open(path).read().splitlines(),
+                             ['TDR\t%d\t2' % page_id])
+
+        merge_detector_logs([path for path, _ in worker_logs])
+        self.assertEqual(open(parent_path).read().splitlines(),
+                         ['TDR\t1\t1', 'TDR\t2\t2', 'TDR\t3\t2'])
@@ -0,0 +1,81 @@
+import threading
+import time
+from unittest import TestCase
+
+from affine.detection.nlp.keywords import index_refresher
+from affine.detection.nlp.keywords.index_refresher import KeywordIndexRefresher
+
+
+class _StubRefresher(KeywordIndexRefresher):
+    """Refresher reading its weighted keywords from a list"""
+
+    def __init__(self, rows):
+        super(_StubRefresher, self).__init__(poll_interval=0)
+        self.db_rows = rows
+
+    def _read_rows(self):
+        return set(self.db_rows)
+
+
+class TestKeywordIndexRefresher(TestCase):
+
+    def setUp(self):
+        self.version = 0
+        self._stamp = index_refresher.weighted_keywords_stamp
+        index_refresher.weighted_keywords_stamp = lambda: self.version
+
+    def tearDown(self):
+        index_refresher.weighted_keywords_stamp = self._stamp
+
+    def test_scores_during_sync_see_whole_diffs(self):
+        old_rows = [(1, ('red', 'car'), 5, 1)]
+        new_rows = [(1, ('red', 'car'), 5, 1), (2, ('car',), 3, 2)]
+        refresher = _StubRefresher(old_rows)
+        refresher.sync()
+
+        # leave the failure links stale for a while after every diff
+        commit = refresher.label_scorer.commit
+        def slow_commit():
+            time.sleep(0.01)
+            commit()
+        refresher.label_scorer.commit = slow_commit
+
+        title, body = ['red', 'car'], []
+        old_hits = {1: [(('red', 'car'), 5)]}
+        new_hits = {1: [(('red', 'car'), 5)], 2: [(('car',), 3)]}
+        hits, errors = [], []
+        stop = threading.Event()
+
+        def score():
+            while not stop.is_set():
+                try:
+                    hits.append(refresher.score_tokens(title, body))
+                except Exception as e:
+                    errors.append(e)
+
+        readers = [threading.Thread(target=score) for _ in xrange(4)]
+        for reader in readers:
+            reader.start()
+        try:
+            for i in xrange(20):
+                self.version += 1
+                refresher.db_rows = new_rows if i % 2 == 0 else old_rows
+                refresher.sync()
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(hits)
+        for hit in hits:
+            self.assertIn(hit, [old_hits, new_hits])
+
+    def test_unchanged_stamp_does_not_read_rows(self):
+        refresher = _StubRefresher([(1, ('car',), 1, 1)])
+        self.assertEqual(refresher.sync(), 1)
+        refresher.db_rows = []
+        self.assertEqual(refresher.sync(), 0)
+        self.version += 1
+        self.assertEqual(refresher.sync(), 1)
+        self.assertEqual(refresher.score_tokens(['car'], []), {})
@@ -0,0 +1,83 @@
+import random
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from affine.model.inventory_page_set import InventoryPageSet
+from affine.model.text_detection_coverage import TextDetectorCoverage, \
+    _timestamp
+
+
+class _FakePages(object):
+    """text_detection_update and last_crawled_video of some web pages"""
+
+    def __init__(self, inventory_ids, other_ids):
+        self.page_set = InventoryPageSet(inventory_ids,
+                                         [1] * len(inventory_ids))
+        self.pages = {page_id: [None, None]
+                      for page_id in list(inventory_ids) + list(other_ids)}
+        # detector id -> max(enabled_since, updated_at)
+        self.detectors = {}
+
+
+class _FakeCoverage(TextDetectorCoverage):
+    """Coverage reading a _FakePages instead of the DB"""
+
+    def __init__(self, db):
+        super(_FakeCoverage, self).__init__()
+        self.db = db
+
+    def _read_page_set(self):
+        return self.db.page_set
+
+    def _read_last_crawl(self):
+        crawls = [crawl for _, crawl in self.db.pages.itervalues() if crawl]
+        return max(crawls) if crawls else None
+
+    def _read_stamps(self, since=None):
+        return [(page_id, stamp)
+                for page_id, (stamp, _) in self.db.pages.iteritems()
+                if stamp is not None and
+                (page_id in self.db.page_set if since is None
+                 else stamp >= since)]
+
+    def _read_resets(self, since=None):
+        return [(page_id, crawl)
+                for page_id, (stamp, crawl) in self.db.pages.iteritems()
+                if stamp is None and crawl is not None and
+                (since is None or crawl >= since)]
+
+    def _read_thresholds(self):
+        return {det_id: _timestamp(dt)
+                for det_id, dt in self.db.detectors.iteritems()}
+
+
+class TestTextDetectorCoverage(TestCase):
+
+    def test_incremental_refreshes_match_full_recounts(self):
+        rand = random.Random(0)
+        db = _FakePages(range(0, 200, 2), range(1, 200, 10))
+        page_ids = sorted(db.pages)
+        now = datetime(2016, 1, 1)
+        db.detectors = {1: now, 2: now + timedelta(hours=1)}
+        coverage = _FakeCoverage(db)
+
+        for step in xrange(300):
+            now += timedelta(minutes=1)
+            for page_id in rand.sample(page_ids, 5):
+                action = rand.random()
+                if action < 0.4:
+                    db.pages[page_id][0] = now
+                elif action < 0.6:
+                    # committed after stamps that were already read
+                    db.pages[page_id][0] = now - timedelta(minutes=5)
+                else:
+                    # WebPage.new_crawl
+                    db.pages[page_id] = [None, now]
+            if step == 150:
+                db.detectors[2] = now
+            if step == 200:
+                db.detectors[3] = now - timedelta(hours=2)
+
+            recount = _FakeCoverage(db)
+            self.assertEqual(coverage.coverage(), recount.coverage())
+            self.assertEqual(coverage.num_updated, recount.num_updated)
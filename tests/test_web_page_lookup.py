@@ -0,0 +1,69 @@
+from collections import namedtuple
+from unittest import TestCase
+
+import affine.normalize_url as normalize
+from affine.model import web_pages
+from affine.model.web_pages import WebPage
+
+_Page = namedtuple('_Page', ['id', 'remote_id'])
+
+
+class _FakeQuery(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def filter(self, *criteria):
+        return list(self.pages)
+
+
+class _FakeSession(object):
+    """Session whose page queries return all pages, in a fixed order"""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def query(self, cls):
+        return _FakeQuery(self.pages)
+
+    def flush(self):
+        pass
+
+
+class TestWebPageLookup(TestCase):
+    """Every url lookup agrees on the page with the lowest id"""
+
+    url = 'http://www.example.com/a'
+    other_url = 'http://www.example.com/b'
+
+    def setUp(self):
+        remote_id = normalize.parse_url(self.url)
+        other_remote_id = normalize.parse_url(self.other_url)
+        self.pages = [_Page(7, remote_id), _Page(3, remote_id),
+                      _Page(5, remote_id), _Page(4, other_remote_id)]
+        self.session = _FakeSession(self.pages)
+        self._session = web_pages.session
+        web_pages.session = self.session
+
+    def tearDown(self):
+        web_pages.session = self._session
+
+    def test_by_url(self):
+        self.assertEqual(WebPage.by_url(self.url, self.session).id, 3)
+        self.assertEqual(WebPage.by_url(self.other_url, self.session).id, 4)
+
+    def test_by_url_in_any_order(self):
+        self.pages.reverse()
+        self.assertEqual(WebPage.by_url(self.url, self.session).id, 3)
+
+    def test_by_url_missing(self):
+        self.assertIsNone(
+            WebPage.by_url('http://www.example.com/c', self.session))
+
+    def test_by_urls(self):
+        pages = WebPage.by_urls([self.url, self.other_url], self.session)
+        self.assertEqual(pages[self.url].id, 3)
+        self.assertEqual(pages[self.other_url].id, 4)
+
+    def test_get_or_create_existing(self):
+        self.assertEqual(WebPage.get_or_create(self.url).id, 3)
@@ -0,0 +1,201 @@
+"""Runs several text detectors over a batch of pages.
+
+Each detector module has a judge_page function that classifies one page
+without touching the DB and returns (ids of clf targets to log, ids of
+detectors whose results are replaced). The pipeline downloads the text of
+all pages concurrently, shares one PageTextContext per page between the
+detectors and one TopicClassifier between batches, and writes the results
+of the whole batch with a few chunked deletes and one log write.
+
+In concurrent mode the judges of all the pages and detectors of a batch run
+at once on a thread pool per backend (the LDA, Spotlight and NER servers,
+the topic model server and the CPU-bound classifiers). The size of each pool
+bounds the calls in flight to its backend. Timeouts stay those of the
+backend clients, so timeouts and errors surface as they do without it.
+"""
+from collections import defaultdict, OrderedDict
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+from affine import config
+from affine.model import AbstractTextDetector, TextDetectorResult, \
+    LanguageDetector, LdaDetector, NamedEntityClassifier, NerDetector, \
+    SentimentClassifier, TopicModelDetector
+from affine.model.base import session
+from affine.model.reference_data import reference_data
+from . import language_detection
+from .lda import detection as lda_detection
+from .nec import detection as nec_detection
+from .ner import detection as ner_detection
+from .page_context import PageTextContext
+from .sentiment_analysis import detection as sentiment_detection
+from .topic_model.detection import TopicClassifier
+
+__all__ = ['TextDetectionPipeline']
+
+logger = getLogger(__name__)
+
+# Backend every detector type waits on in concurrent mode
+BACKENDS = {
+    LanguageDetector: 'cpu',
+    LdaDetector: 'lda',
+    NamedEntityClassifier: 'spotlight',
+    NerDetector: 'ner',
+    SentimentClassifier: 'cpu',
+    TopicModelDetector: 'topic',
+}
+# Default calls in flight per backend, affine.text_detection.<backend>.
+# max_in_flight overrides it. A timed out NER server is killed, which would
+# fail the other calls in flight, so NER defaults to one call.
+MAX_IN_FLIGHT = {'lda': 8, 'spotlight': 8, 'ner': 1}
+# The topic model server reads one request at a time from a named pipe and
+# the CPU-bound classifiers would only contend for the GIL
+SERIAL_BACKENDS = ('cpu', 'topic')
+
+
+class TextDetectionPipeline(object):
+    """Batched driver for the text detectors.
+
+    The results written for every page are the same as running the
+    process_page function of each detector type on it in turn.
+    """
+
+    def __init__(self, concurrent=False):
+        self.concurrent = concurrent
+        self.topic_classifier = None
+        # backend -> ThreadPool
+        self._pools = {}
+        self._judges = OrderedDict([
+            (LanguageDetector, lambda context, dets:
+                language_detection.judge_page(context)),
+            (LdaDetector, lda_detection.judge_page),
+            (NamedEntityClassifier, nec_detection.judge_page),
+            (NerDetector, ner_detection.judge_page),
+            (SentimentClassifier, sentiment_detection.judge_page),
+            (TopicModelDetector, lambda context, dets:
+                self._topic_classifier().judge_page(context)),
+        ])
+        # models each detector type loads once per process
+        self._warm_ups = {
+            LanguageDetector: lambda dets:
+                LanguageDetector.detect_language(u'warm up'),
+            LdaDetector: lambda dets:
+                map(lda_detection.load_detector_model, dets),
+            NerDetector: lambda dets: map(ner_detection.load_svm_model, dets),
+            SentimentClassifier: lambda dets:
+                sentiment_detection.lexical_classifier(),
+            TopicModelDetector: lambda dets:
+                self._topic_classifier().load_models(),
+        }
+
+    def _topic_classifier(self):
+        if self.topic_classifier is None:
+            self.topic_classifier = TopicClassifier()
+        return self.topic_classifier
+
+    def supports(self, detector):
+        return any(isinstance(detector, det_cls) for det_cls in self._judges)
+
+    def close(self):
+        """Stops the thread pools and the topic model server"""
+        for pool in self._pools.itervalues():
+            pool.close()
+            pool.join()
+        self._pools = {}
+        if self.topic_classifier is not None:
+            self.topic_classifier.stop_server()
+
+    def _pool(self, backend):
+        pool = self._pools.get(backend)
+        if pool is None:
+            if backend in SERIAL_BACKENDS:
+                size = 1
+            else:
+                size = config.get('affine.text_detection.%s.max_in_flight'
+                                  % backend, MAX_IN_FLIGHT[backend])
+            pool = self._pools[backend] = ThreadPool(size)
+        return pool
+
+    def _judge(self, det_cls, context, dets):
+        """Runs on a pool thread, which has a session of its own"""
+        try:
+            return self._judges[det_cls](context, dets)
+        finally:
+            session.close()
+
+    def _group_detectors(self, detectors):
+        """Detectors grouped by type, in the order the types first appear"""
+        groups = OrderedDict()
+        for det in detectors:
+            for det_cls in self._judges:
+                if isinstance(det, det_cls):
+                    groups.setdefault(det_cls, []).append(det)
+                    break
+            else:
+                raise TypeError('No batch judge for detector %s' % det.name)
+        return groups
+
+    def warm_up(self, detectors):
+        """Loads reference data and the models of detectors up front"""
+        reference_data()
+        for det_cls, dets in self._group_detectors(detectors).iteritems():
+            warm_up = self._warm_ups.get(det_cls)
+            if warm_up is not None:
+                warm_up(dets)
+
+    def judge_pages(self, pages, detectors):
+        """Runs the detectors on pages without writing anything.
+
+        Returns (results, deletes): a list of (page_id, clf_target_id) to
+        log and a dict mapping page_id to the ids of detectors whose results
+        are deleted before the new results are written. A page on which a
+        detector fails is logged and left out of both.
+        """
+        contexts = [PageTextContext.of(page) for page in pages]
+        PageTextContext.prefetch(contexts)
+        groups = self._group_detectors(detectors)
+        judgements = []
+        for context in contexts:
+            for det_cls, dets in groups.iteritems():
+                judgement = None
+                if self.concurrent:
+                    judgement = self._pool(BACKENDS[det_cls]).apply_async(
+                        self._judge, (det_cls, context, dets))
+                judgements.append((context, det_cls, dets, judgement))
+
+        results = []
+        deletes = defaultdict(set)
+        failed = set()
+        for context, det_cls, dets, judgement in judgements:
+            if context.id in failed:
+                continue
+            try:
+                if self.concurrent:
+                    judgement = judgement.get()
+                else:
+                    judgement = self._judges[det_cls](context, dets)
+            except Exception:
+                logger.exception('%s failed on page %s, skipping the page',
+                                 det_cls.__name__, context.id)
+                failed.add(context.id)
+                continue
+            if judgement is None:
+                continue
+            clf_target_ids, detector_ids = judgement
+            results.extend((context.id, clf_target_id)
+                           for clf_target_id in clf_target_ids)
+            deletes[context.id].update(detector_ids)
+        if failed:
+            results = [result for result in results if result[0] not in failed]
+            for page_id in failed:
+                deletes.pop(page_id, None)
+        return results, deletes
+
+    def process_pages(self, pages, detectors):
+        """Runs the detectors on pages and writes the results of the batch"""
+        results, deletes = self.judge_pages(pages, detectors)
+        AbstractTextDetector.delete_detector_results_for_pages(deletes)
+        TextDetectorResult.log_results(results)
+        logger.info('Ran %d text detectors on %d pages, %d results',
+                    len(detectors), len(deletes), len(results))
+        return results
@@ -0,0 +1,417 @@
+"""Runs the text detectors over a stream of page ids on all cores.
+
+The parent process shards the page ids into batches and hands them to
+worker processes. Every worker loads the reference data and the models of
+its detectors once at startup (langid, the sentiment lexicon, LDA configs
+and vocabularies, NER and topic SVMs) and keeps them warm for every batch
+it runs through a TextDetectionPipeline. After each batch a worker closes
+its detector log and hands the file to the parent, which merges the files
+and loads them with one flush_detector_log_to_db.
+
+Workers that die, or spend more than batch_timeout seconds on a batch, are
+replaced and their batch is split in two halves that are queued again, so a
+page that kills its worker ends up alone in a batch. Only such single pages
+are given up; their ids are appended to the lost page ids file, one per
+line, so they can be rerun with -page-ids. Workers that fail to start are
+restarted with exponential backoff, and the pool only gives up once every
+worker failed to start START_RETRIES times in a row. SIGTERM or SIGINT makes
+the parent stop handing out batches, wait for the ones in flight and flush.
+
+    python -m affine.detection.nlp.text_worker_pool -page-ids page_ids.txt
+"""
+import argparse
+import errno
+import multiprocessing
+import os
+import Queue
+import select
+import signal
+import sys
+import time
+import traceback
+from logging import getLogger
+
+from affine import config
+from affine.model import AbstractTextDetector, WebPage, \
+    detach_detector_log, flush_detector_log_to_db, merge_detector_logs, \
+    rotate_detector_log
+from affine.model.base import metadata, session
+from .text_pipeline import TextDetectionPipeline
+
+__all__ = ['TextDetectionWorkerPool']
+
+logger = getLogger(__name__)
+
+BATCH_SIZE = 100
+# Seconds a worker may spend on one batch before it is replaced
+BATCH_TIMEOUT = 1800
+# Batches whose logs are merged and loaded with one flush
+FLUSH_BATCHES = 50
+# Consecutive start failures per worker before the pool gives up
+START_RETRIES = 3
+# Seconds before restarting a worker after the first failed start, doubled
+# with every further failure up to MAX_RESTART_DELAY
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+
+
+def default_lost_page_ids_path():
+    return os.path.join(config.log_dir(), 'text_worker_pool_lost_page_ids.txt')
+
+
+def _load_detectors(detector_ids):
+    query = AbstractTextDetector.query
+    return query.filter(AbstractTextDetector.id.in_(detector_ids)).all()
+
+
+def _worker_main(detector_ids, tasks, conn, concurrent):
+    """Runs batches from tasks until it gets None or SIGTERM.
+
+    Reports to the parent through conn, whose sends are written before they
+    return, so nothing is lost if the worker dies afterwards.
+    """
+    # the detector log globals still point at the log of the parent
+    detach_detector_log()
+    stopping = []
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    # Finish the batch in flight instead of failing its I/O with EINTR
+    signal.siginterrupt(signal.SIGTERM, False)
+    try:
+        pipeline = TextDetectionPipeline(concurrent)
+        pipeline.warm_up(_load_detectors(detector_ids))
+    except Exception:
+        conn.send(('failed', None, traceback.format_exc()))
+        return
+    finally:
+        session.close()
+    conn.send(('ready', None, os.getpid()))
+
+    try:
+        while not stopping:
+            try:
+                task = tasks.get(timeout=1)
+            except Queue.Empty:
+                continue
+            except IOError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            if task is None:
+                break
+            batch_id, page_ids = task
+            conn.send(('started', batch_id, None))
+            kind = 'done'
+            try:
+                pages = WebPage.query.filter(WebPage.id.in_(page_ids)).all()
+                pipeline.process_pages(pages, _load_detectors(detector_ids))
+            except Exception:
+                logger.exception('Text detection failed for pages %d-%d',
+                                 page_ids[0], page_ids[-1])
+                kind = 'error'
+            finally:
+                session.close()
+            conn.send((kind, batch_id, rotate_detector_log()))
+    finally:
+        pipeline.close()
+
+
+class TextDetectionWorkerPool(object):
+    """Process pool running a TextDetectionPipeline in every worker"""
+
+    def __init__(self, detector_ids, num_workers=None, batch_size=BATCH_SIZE,
+                 batch_timeout=BATCH_TIMEOUT, flush_batches=FLUSH_BATCHES,
+                 concurrent=False, lost_page_ids_path=None):
+        self.detector_ids = list(detector_ids)
+        # whether workers overlap the I/O of the pages of a batch
+        self.concurrent = concurrent
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.flush_batches = flush_batches
+        self.lost_page_ids_path = \
+            lost_page_ids_path or default_lost_page_ids_path()
+        self.tasks = multiprocessing.Queue()
+        # worker id -> (process, connection it reports through)
+        self.workers = {}
+        # worker id -> (batch id, time the worker started it)
+        self.assignments = {}
+        # batch id -> (page ids, time it was queued), until it is finished
+        self.pending = {}
+        self.log_paths = []
+        self.stats = dict.fromkeys(
+            ['batches', 'pages', 'errors', 'requeued', 'lost', 'restarts',
+             'start_failures'], 0)
+        self.worker_batches = {}
+        # start failures since a worker last became ready
+        self.start_failures = 0
+        # times at which to start the workers that replace dead ones
+        self.restart_times = []
+        # highest id of a batch a worker started
+        self.last_started_batch_id = -1
+        self.stopping = False
+        self._next_worker_id = 0
+        self._next_batch_id = 0
+
+    def start(self):
+        # Workers must not share the connections of the parent
+        session.close()
+        metadata.bind.dispose()
+        for _ in xrange(self.num_workers):
+            self._start_worker()
+
+    def _start_worker(self):
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(
+            target=_worker_main, name='text-worker-%d' % worker_id,
+            args=(self.detector_ids, self.tasks, writer, self.concurrent))
+        proc.daemon = True
+        proc.start()
+        writer.close()
+        self.workers[worker_id] = (proc, reader)
+        self.worker_batches[worker_id] = 0
+
+    def stop(self):
+        """Stop handing out batches; process returns once the batches in
+        flight are finished"""
+        self.stopping = True
+
+    def process(self, page_ids):
+        """Runs the detectors on an iterable of page ids, read lazily.
+
+        Returns the stats of the pool.
+        """
+        batches = self._batches(page_ids)
+        max_in_flight = 2 * self.num_workers
+        try:
+            while True:
+                while not self.stopping and len(self.pending) < max_in_flight:
+                    page_id_batch = next(batches, None)
+                    if page_id_batch is None:
+                        self.stop()
+                        break
+                    self._dispatch(page_id_batch)
+                if not self.pending:
+                    break
+                self._poll()
+                if len(self.log_paths) >= self.flush_batches:
+                    self.flush()
+        finally:
+            self.flush()
+        return self.stats
+
+    def _batches(self, page_ids):
+        batch = []
+        for page_id in page_ids:
+            batch.append(page_id)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _dispatch(self, page_ids):
+        batch_id = self._next_batch_id
+        self._next_batch_id += 1
+        self.pending[batch_id] = (page_ids, time.time())
+        self.tasks.put((batch_id, page_ids))
+
+    def _poll(self, timeout=1):
+        readers = {conn: worker_id
+                   for worker_id, (_, conn) in self.workers.iteritems()}
+        try:
+            ready, _, _ = select.select(list(readers), [], [], timeout)
+        except select.error as e:
+            # interrupted by the signal that stops the pool
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        for conn in ready:
+            self._receive(readers[conn], conn)
+        self.check_health()
+
+    def _receive(self, worker_id, conn):
+        """Handles one message of a worker, returns False at end of file"""
+        try:
+            kind, batch_id, payload = conn.recv()
+        except EOFError:
+            return False
+        if kind == 'failed':
+            logger.error('Text worker %d failed to start:\n%s',
+                         worker_id, payload)
+            self.stats['start_failures'] += 1
+            self.start_failures += 1
+            if self.start_failures >= START_RETRIES * self.num_workers:
+                raise RuntimeError('Text workers failed to start %d times in '
+                                   'a row' % self.start_failures)
+        elif kind == 'ready':
+            logger.info('Text worker %d ready (pid %d)', worker_id, payload)
+            self.start_failures = 0
+        elif kind == 'started':
+            self.assignments[worker_id] = (batch_id, time.time())
+            self.last_started_batch_id = max(batch_id,
+                                             self.last_started_batch_id)
+        else:
+            self.assignments.pop(worker_id, None)
+            # a batch counted as lost can still be finished
+            page_ids, _ = self.pending.pop(batch_id, ([], None))
+            if payload is not None:
+                self.log_paths.append(payload)
+            self.worker_batches[worker_id] += 1
+            self.stats['batches'] += 1
+            self.stats['pages'] += len(page_ids)
+            if kind == 'error':
+                self.stats['errors'] += 1
+        return True
+
+    def check_health(self):
+        """Replaces workers that died or are stuck on a batch"""
+        now = time.time()
+        for worker_id, (proc, conn) in self.workers.items():
+            assignment = self.assignments.get(worker_id)
+            stuck = assignment is not None and \
+                now - assignment[1] > self.batch_timeout
+            if proc.is_alive() and not stuck:
+                continue
+            if stuck:
+                logger.error('Text worker %d is stuck, killing it', worker_id)
+                os.kill(proc.pid, signal.SIGKILL)
+            proc.join()
+            if not stuck:
+                logger.error('Text worker %d died with exit code %s',
+                             worker_id, proc.exitcode)
+            # batches it finished before it died
+            while conn.poll() and self._receive(worker_id, conn):
+                pass
+            conn.close()
+            del self.workers[worker_id]
+            assignment = self.assignments.pop(worker_id, None)
+            if assignment is not None:
+                self._lose_batch(assignment[0])
+            self._schedule_restart()
+        for restart_at in sorted(self.restart_times):
+            if restart_at > now:
+                break
+            self.restart_times.remove(restart_at)
+            self.stats['restarts'] += 1
+            self._start_worker()
+        # A worker can die between taking a batch and reporting it. Batches
+        # are taken in order, so such a batch is older than a started one.
+        assigned = {batch_id for batch_id, _ in self.assignments.itervalues()}
+        for batch_id, (_, queued_at) in self.pending.items():
+            if batch_id not in assigned and \
+                    batch_id < self.last_started_batch_id and \
+                    now - queued_at > 2 * self.batch_timeout:
+                self._lose_batch(batch_id)
+
+    def _schedule_restart(self):
+        delay = 0
+        if self.start_failures:
+            delay = min(MAX_RESTART_DELAY,
+                        RESTART_DELAY * 2 ** (self.start_failures - 1))
+            logger.info('Restarting a text worker in %d seconds', delay)
+        self.restart_times.append(time.time() + delay)
+
+    def _lose_batch(self, batch_id):
+        """Queues the halves of a batch again, gives up on single pages"""
+        page_ids, _ = self.pending.pop(batch_id)
+        if len(page_ids) > 1:
+            logger.error('Lost batch of pages %d-%d, queueing its halves '
+                         'again', page_ids[0], page_ids[-1])
+            self.stats['requeued'] += 1
+            middle = len(page_ids) // 2
+            self._dispatch(page_ids[:middle])
+            self._dispatch(page_ids[middle:])
+            return
+        logger.error('Lost page %d, writing it to %s',
+                     page_ids[0], self.lost_page_ids_path)
+        self.stats['lost'] += 1
+        with open(self.lost_page_ids_path, 'a') as fo:
+            fo.write('%d\n' % page_ids[0])
+
+    def health(self):
+        """Dict mapping worker id to its pid, liveness, batches done and
+        seconds spent on its current batch"""
+        now = time.time()
+        health = {}
+        for worker_id, (proc, _) in self.workers.iteritems():
+            assignment = self.assignments.get(worker_id)
+            health[worker_id] = dict(
+                pid=proc.pid, alive=proc.is_alive(),
+                batches=self.worker_batches[worker_id],
+                busy_seconds=now - assignment[1] if assignment else None)
+        return health
+
+    def flush(self):
+        """Merges the logs the workers handed over and loads them to the DB"""
+        if self.log_paths:
+            merge_detector_logs(self.log_paths)
+            self.log_paths = []
+        flush_detector_log_to_db()
+
+    def close(self, timeout=60):
+        """Lets the workers finish and exit, killing those that do not"""
+        for _ in self.workers:
+            self.tasks.put(None)
+        deadline = time.time() + timeout
+        for proc, conn in self.workers.itervalues():
+            proc.join(max(0, deadline - time.time()))
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGKILL)
+                proc.join()
+            conn.close()
+        self.workers = {}
+
+
+def _read_page_ids(path):
+    with (sys.stdin if path == '-' else open(path)) as page_ids_file:
+        for line in page_ids_file:
+            line = line.strip()
+            if line:
+                yield int(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run text detection on pages with a pool of processes')
+    parser.add_argument('-page-ids', dest='page_ids', required=True,
+                        help='File with one page id per line, - for stdin')
+    parser.add_argument('-detector-ids', dest='detector_ids', type=int,
+                        nargs='+', help='Detectors to run, all enabled ones '
+                        'the pipeline supports if not given')
+    parser.add_argument('-workers', dest='num_workers', type=int,
+                        default=None, help='Worker processes, one per core '
+                        'if not given')
+    parser.add_argument('-batch-size', dest='batch_size', type=int,
+                        default=BATCH_SIZE, help='Pages per batch')
+    parser.add_argument('-concurrent', dest='concurrent', action='store_true',
+                        help='Overlap the backend calls of the pages of a batch')
+    parser.add_argument('-lost-page-ids', dest='lost_page_ids', default=None,
+                        help='File the ids of pages that could not be '
+                        'processed are appended to, under the log dir if '
+                        'not given')
+    args = parser.parse_args()
+
+    detector_ids = args.detector_ids
+    if detector_ids is None:
+        pipeline = TextDetectionPipeline()
+        query = AbstractTextDetector.query.filter(
+            AbstractTextDetector.enabled_since != None)
+        detector_ids = [det.id for det in query if pipeline.supports(det)]
+
+    pool = TextDetectionWorkerPool(detector_ids, args.num_workers,
+                                   args.batch_size, concurrent=args.concurrent,
+                                   lost_page_ids_path=args.lost_page_ids)
+    for signum in signal.SIGTERM, signal.SIGINT:
+        signal.signal(signum, lambda signum, frame: pool.stop())
+    pool.start()
+    try:
+        stats = pool.process(_read_page_ids(args.page_ids))
+    finally:
+        pool.close()
+    logger.info('Text worker pool finished: %s', stats)
+
+if __name__ == '__main__':
+    main()
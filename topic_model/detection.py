@@ -2,15 +2,15 @@ from logging import getLogger
 import os
 import cPickle as pickle
 import subprocess
-import sys
 import shutil
-import unicodedata
 import uuid
 
 from affine import config
 from affine.aws import s3client
 from affine.detection.model.classifiers import LibsvmClassifier
-from affine.model import Label, session, TopicModelDetector, TextDetectionVersion, ClassifierTarget
+from affine.model import Label, TopicModelDetector, TextDetectionVersion, TextDetectorResult
+from affine.model.reference_data import reference_data, reference_lookup
+from ..page_context import PageTextContext, control_characters_table
 
 logger = getLogger(__name__)
 
@@ -23,6 +23,9 @@ class TopicClassifier(object):
         """
         self.server = None
         self.current_version = None
+        # category -> SVM or topic map of the current version
+        self.svm_models = {}
+        self.topic_maps = {}
 
     def start_server(self):
         if self.server is not None:
@@ -34,6 +37,8 @@ class TopicClassifier(object):
         self.model_files_dir = os.path.join(config.scratch_detector_path(),
                 model_file_dir_name)
         self.grab_s3_files()
+        self.svm_models = {}
+        self.topic_maps = {}
 
         self.load_category_data(os.path.join(self.model_files_dir, "category_info.pickle"))
         self.create_named_pipes()
@@ -157,12 +162,35 @@ class TopicClassifier(object):
         return {int(t) : float(v)
                 for t, v in zip(d[2::2], d[3::2])}
 
+    def load_models(self):
+        """Starts the server and loads the topic map and the SVMs of every
+        category, so the first pages do not pay for it"""
+        self.configure_server()
+        self.topic_map(TopicClassifier.YT)
+        for category in set(self.category_dict.itervalues()):
+            self.svm_model(category)
+
+    def topic_map(self, category):
+        try:
+            return self.topic_maps[category]
+        except KeyError:
+            topic_category_pickle = os.path.join(self.model_files_dir,
+                                                 "%s.topic_map" % category)
+            with open(topic_category_pickle,"rb") as f:
+                topic_map = self.topic_maps[category] = pickle.load(f)
+            return topic_map
+
+    def svm_model(self, category):
+        try:
+            return self.svm_models[category]
+        except KeyError:
+            model_file = os.path.join(self.model_files_dir, "%s.svm_model" % category)
+            clf = self.svm_models[category] = LibsvmClassifier.load_from_file(model_file)
+            return clf
+
     def manual_predict(self, feature_vector, category):
         """Do prediction using human matched topics"""
-        topic_category_pickle = os.path.join(self.model_files_dir,
-                                             "%s.topic_map" % category)
-        with open(topic_category_pickle,"rb") as f:
-            topic_category_dict = pickle.load(f)
+        topic_category_dict = self.topic_map(category)
         sorted_topics = feature_vector.items()
         sorted_topics.sort(key = lambda x:x[1], reverse=True)
         for topic, proportion in sorted_topics:
@@ -175,18 +203,15 @@ class TopicClassifier(object):
 
     def svm_predict(self, feature_vector, category):
         """Do prediction using trained SVM"""
-        model_file = os.path.join(self.model_files_dir, "%s.svm_model" % category)
-        clf = LibsvmClassifier.load_from_file(model_file)
+        clf = self.svm_model(category)
         return clf.predict([feature_vector])[0]
 
     def remove_control(self, text):
         """ Remove unicode control characters from input text and returns clean text
         """
-        tbl = {i : None for i in xrange(sys.maxunicode)
-            if unicodedata.category(unichr(i)) in ('Zp','Zl','Cf','Cc')}
         if not isinstance(text, unicode):
             text = text.decode('utf-8')
-        return text.translate(tbl).encode('utf-8')
+        return text.translate(control_characters_table()).encode('utf-8')
 
     def process_text(self, text_string):
         """ High level function that takes a text string and returns classification
@@ -196,7 +221,11 @@ class TopicClassifier(object):
 
         Returns: Tuple (Tier1 category, Tier2 category)
         """
-        text_string = self.remove_control(text_string)
+        return self.process_clean_text(self.remove_control(text_string))
+
+    def process_clean_text(self, text_string):
+        """ process_text for utf-8 text that has had control characters removed
+        """
         if text_string == "":
             return (None,None)
         tier1_label_id = self.infer_label_from_text(text_string, TopicClassifier.YT)
@@ -207,25 +236,45 @@ class TopicClassifier(object):
         return self.category_info[tier2_label_id]
 
     def process_page(self, page):
+        context = PageTextContext.of(page)
+        page = context.page
         logger.info("Assessing Topic Models for Page: %s" %page.id)
-        self.configure_server()
-        label1, label2 = self.process_text(page.title_and_text)
-        matching_label_ids = []
-
-        ctl, tmd = ClassifierTarget, TopicModelDetector
-        for label_id in label1, label2:
-            if label_id is not None:
-
-                query = tmd.query.join(tmd.clf_targets)
-                query = query.filter_by(target_label_id=label_id)
-                det = query.one()
+        clf_target_ids, detector_ids_to_delete = self.judge_page(context)
+        for clf_target_id in clf_target_ids:
+            TextDetectorResult.log_result(page.id, clf_target_id)
+        TopicModelDetector.delete_detector_results(page, detector_ids_to_delete)
 
-                assert det is not None, 'No detector found for label %d' % label_id
-                det.save_result(page.id)
-                matching_label_ids.append(label_id)
+    def judge_page(self, page):
+        """ Topic classification without writing results
 
-        query = session.query(tmd.id)
+        Returns (ids of clf targets to log, ids of detectors whose results
+        should be deleted)
+        """
+        context = PageTextContext.of(page)
+        self.configure_server()
+        label1, label2 = self.process_clean_text(
+            context.control_stripped_text.encode('utf-8'))
+        matching_label_ids = [label_id for label_id in (label1, label2)
+                              if label_id is not None]
+
+        def lookup(ref):
+            tmd_ids = ref.classifier_ids(TopicModelDetector)
+            clf_target_ids = []
+            for label_id in matching_label_ids:
+                det_ids = [ct.clf_id for ct in ref.clf_targets_with_label(label_id)
+                           if ct.clf_id in tmd_ids]
+                if len(det_ids) != 1:
+                    raise KeyError('%d detectors found for label %d' %
+                                   (len(det_ids), label_id))
+                clf_target_ids.append(ref.clf_target(det_ids[0]).id)
+            return tmd_ids, clf_target_ids
+        tmd_ids, clf_target_ids = reference_lookup(lookup)
+
+        ref = reference_data()
         if matching_label_ids:
-            query = query.join(ctl).filter(~ctl.target_label_id.in_(matching_label_ids))
-        detector_ids_to_delete = {id for (id,) in query}
-        TopicModelDetector.delete_detector_results(page, detector_ids_to_delete)
+            detector_ids_to_delete = {
+                ct.clf_id for tmd_id in tmd_ids for ct in ref.clf_targets_of(tmd_id)
+                if ct.target_label_id not in matching_label_ids}
+        else:
+            detector_ids_to_delete = set(tmd_ids)
+        return clf_target_ids, detector_ids_to_delete